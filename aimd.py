@@ -0,0 +1,198 @@
+"""Adaptive per-provider concurrency limits (additive increase, multiplicative decrease).
+
+Every upstream call takes a slot from its provider's limit and waits in FIFO
+order when none is free. A call that succeeds while the limit is in full use
+raises the limit by 1/limit, so roughly one extra slot per limit's worth of
+successes. A 429, a timeout, or a call much slower than the recent median
+for its kind cuts the limit by AIMD_DECREASE, at most once per AIMD_COOLDOWN
+seconds so a burst of failures from one overload counts once.
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import openai
+import requests
+
+from retry import status_code
+
+AIMD_DECREASE = float(os.getenv("AIMD_DECREASE", "0.5"))
+AIMD_COOLDOWN = float(os.getenv("AIMD_COOLDOWN", "1"))
+# A call slower than this multiple of the recent median for its label is a congestion signal
+AIMD_LATENCY_FACTOR = float(os.getenv("AIMD_LATENCY_FACTOR", "3"))
+LATENCY_WINDOW = 100
+
+# Initial, minimum and maximum concurrent calls per provider
+DEFAULT_LIMITS = {
+    "openai": (8, 1, 64),
+    "freepik": (4, 1, 16),
+}
+
+logger = logging.getLogger(__name__)
+
+
+def is_congestion(error):
+    """Whether ``error`` means the provider is overloaded, not that the request was bad."""
+    if isinstance(error, (TimeoutError, openai.APITimeoutError, requests.Timeout)):
+        return True
+    return status_code(error) == 429 and getattr(error, "code", None) != "insufficient_quota"
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(fraction * (len(values) - 1))]
+
+
+class AdaptiveLimit:
+    """AIMD concurrency limit for one provider, with a FIFO queue of waiting calls.
+
+    Waiters are asyncio futures, so a limit must only be awaited from the
+    shared pipeline event loop; the lock keeps snapshot() consistent for
+    other threads.
+    """
+
+    def __init__(self, name, initial=8, minimum=1, maximum=64):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.decreases = 0
+        self.last_decrease = None
+        self._decreased_at = 0.0
+        self._waiters = deque()
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    async def _acquire(self):
+        """Take a slot; return whether the limit was in full use."""
+        with self._lock:
+            if not self._waiters and self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return self.in_flight >= int(self.limit)
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    # Granted a slot just as we were cancelled; hand it on.
+                    self.in_flight -= 1
+                    self._wake()
+            raise
+        return True
+
+    def _release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._wake()
+
+    def decrease(self, reason):
+        """Cut the limit multiplicatively, unless it was cut within the cooldown."""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._decreased_at < AIMD_COOLDOWN:
+                return
+            old = self.limit
+            self.limit = max(self.minimum, self.limit * AIMD_DECREASE)
+            self._decreased_at = now
+            self.decreases += 1
+            self.last_decrease = (time.time(), reason)
+        logger.info("%s concurrency %.1f -> %.1f: %s", self.name, old, self.limit, reason)
+
+    def record_error(self, label, error):
+        if is_congestion(error):
+            self.decrease(f"{label}: {error}")
+
+    def record_success(self, label, latency, saturated):
+        with self._lock:
+            window = self._latencies.setdefault(label, deque(maxlen=LATENCY_WINDOW))
+            slow = len(window) >= 10 and latency > AIMD_LATENCY_FACTOR * percentile(window, 0.5)
+            window.append(latency)
+            if not slow and saturated:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self._wake()
+        if slow:
+            self.decrease(f"{label} took {latency:.1f}s")
+
+    @contextlib.asynccontextmanager
+    async def slot(self, label):
+        """Hold one of the provider's slots for the block, feeding its outcome back into the limit.
+
+        ``label`` names the latency window the block's duration is compared
+        against, so it should only be shared by calls of similar length.
+        """
+        saturated = await self._acquire()
+        started = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self.record_error(label, e)
+            raise
+        finally:
+            self._release()
+        self.record_success(label, time.monotonic() - started, saturated)
+
+    async def acall(self, label, fn):
+        """Await ``fn()`` in one of the provider's slots (see slot())."""
+        async with self.slot(label):
+            return await fn()
+
+    def snapshot(self):
+        """Current state as a plain dict, for display and metrics."""
+        with self._lock:
+            return {
+                "name": self.name,
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "queued": len(self._waiters),
+                "decreases": self.decreases,
+                "last_decrease": self.last_decrease,
+                "latency": {
+                    label: {"p50": percentile(window, 0.5), "p95": percentile(window, 0.95)}
+                    for label, window in self._latencies.items() if window
+                },
+            }
+
+
+_limits = {}
+_limits_lock = threading.Lock()
+
+
+def get_adaptive_limit(name):
+    """Return the process-wide adaptive limit for provider ``name``.
+
+    Bounds come from ``<NAME>_CONCURRENCY_INITIAL``, ``<NAME>_CONCURRENCY_MIN``
+    and ``<NAME>_CONCURRENCY_MAX``.
+    """
+    with _limits_lock:
+        if name not in _limits:
+            prefix = name.upper()
+            initial, minimum, maximum = DEFAULT_LIMITS.get(name, (4, 1, 16))
+            _limits[name] = AdaptiveLimit(
+                name,
+                initial=float(os.getenv(f"{prefix}_CONCURRENCY_INITIAL", initial)),
+                minimum=float(os.getenv(f"{prefix}_CONCURRENCY_MIN", minimum)),
+                maximum=float(os.getenv(f"{prefix}_CONCURRENCY_MAX", maximum))
+            )
+        return _limits[name]
+
+
+def all_adaptive_limits():
+    """Every adaptive limit created so far."""
+    with _limits_lock:
+        return list(_limits.values())
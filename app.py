@@ -1,14 +1,23 @@
-import os
+import time
+
+import altair as alt
 import openai
-import requests
+import pandas as pd
 import streamlit as st
 from dotenv import load_dotenv
 
-# Load environment variables
+# Project modules read their settings from the environment when imported,
+# so .env has to be loaded before any of them.
 load_dotenv()
 
-# Configure OpenAI
-openai.api_key = os.getenv("OPENAI_API_KEY")
+from aimd import all_adaptive_limits
+from breaker import all_breakers
+from images import DISPLAY_WIDTH, get_image_store
+from jobs import CANCELLED, RUNNING, get_job_manager, load_checkpoint
+from metrics import start_server
+from pipeline import STAGE_ERRORS, STAGES, hedge_counts, store_image
+from ratelimit import all_limiters
+from tracing import get_trace
 
 # Page configuration
 st.set_page_config(
@@ -19,124 +28,39 @@ st.set_page_config(
 
 
 
+@st.cache_resource
+def start_metrics_endpoint():
+    """Serve Prometheus metrics next to the app, once per server process."""
+    return start_server()
+
+
+start_metrics_endpoint()
+
 # Initialize session state
 if 'generated_content' not in st.session_state:
     st.session_state.generated_content = None
+if 'job_messages' not in st.session_state:
+    st.session_state.job_messages = []
+if 'job_id' not in st.session_state:
+    # A refreshed page picks its running job back up from the URL.
+    st.session_state.job_id = st.query_params.get("job")
+if 'resume_job_id' not in st.session_state:
+    st.session_state.resume_job_id = None
 
 
-def get_freepik_image(title):
-    """Attempt to get an image from Freepik API."""
-    try:
-        api_key = os.getenv("FREEPIK_API_KEY")
-        if not api_key:
-            return None
-        
-        headers = {"Authorization": f"Bearer {api_key}"}
-        params = {
-            "term": title,
-            "limit": 1,
-            "filters[content_type]": "photo"
-        }
-        
-        response = requests.get(
-            "https://api.freepik.com/v1/resources",
-            headers=headers,
-            params=params,
-            timeout=10
-        )
-        
-        if response.status_code == 200:
-            data = response.json()
-            if data.get("data") and len(data["data"]) > 0:
-                item = data["data"][0]
-                if "attributes" in item and "preview" in item["attributes"]:
-                    return item["attributes"]["preview"].get("url")
-                elif "images" in item and "preview" in item["images"]:
-                    return item["images"]["preview"].get("url")
-        return None
-    except Exception as e:
-        st.warning(f"Freepik API error: {str(e)}")
-        return None
-
-
-def generate_dalle_image(title):
-    """Generate an image using DALL-E as fallback."""
-    try:
-        response = openai.images.generate(
-            model="dall-e-3",
-            prompt=f"Create a modern, professional header image for an article titled '{title}'. The image should be visually appealing and relevant to the topic.",
-            size="1024x1024",
-            quality="standard",
-            n=1
-        )
-        return response.data[0].url
-    except Exception as e:
-        st.error(f"DALL-E generation error: {str(e)}")
-        return None
-
-
-def generate_outline(title, word_range):
-    """Generate article outline using GPT-4 Turbo."""
-    try:
-        response = openai.chat.completions.create(
-            model=os.getenv("OPENAI_VERSION"),
-            messages=[{
-                "role": "user",
-                "content": f"Create a detailed, structured outline for an article titled '{title}' that should be approximately {word_range} words. Format it as a clear, hierarchical outline with main sections and subsections."
-            }],
-            temperature=0.7
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        st.error(f"Outline generation error: {str(e)}")
-        return None
-
-
-def write_article(title, outline, word_range):
-    """Write full article using the outline and word range."""
-    try:
-        response = openai.chat.completions.create(
-            model=os.getenv("OPENAI_VERSION"),
-            messages=[{
-                "role": "user",
-                "content": f"Write a complete, well-researched article titled '{title}' using this outline:\n\n{outline}\n\nThe article should be approximately {word_range} words. Make it engaging, informative, and professional. Include an introduction, well-structured body paragraphs, and a conclusion."
-            }],
-            temperature=0.8
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        st.error(f"Article writing error: {str(e)}")
-        return None
-
-
-def suggest_resources(title):
-    """Suggest authoritative resources related to the article topic."""
-    try:
-        response = openai.chat.completions.create(
-            model=os.getenv("OPENAI_VERSION"),
-            messages=[{
-                "role": "user",
-                "content": f"Provide 5 authoritative online resources (websites, articles, studies, or references) related to '{title}'. Format each as a clear title and description. Include why each resource is valuable."
-            }],
-            temperature=0.7
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        st.error(f"Resource suggestion error: {str(e)}")
-        return None
+ARTICLE_MODES = {
+    "Streamed": ("single", True),
+    "Single pass": ("single", False),
+    "Section-parallel": ("sections", False),
+}
 
-
-def generate_header_image(title):
-    """Generate header image with Freepik first, DALL-E fallback."""
-    freepik_image = get_freepik_image(title)
-    if freepik_image:
-        return freepik_image, "Freepik"
-    
-    dalle_image = generate_dalle_image(title)
-    if dalle_image:
-        return dalle_image, "DALL-E"
-    
-    return None, None
+STAGE_LABELS = {
+    "outline": "📋 Article outline",
+    "article": "✍️ Full article",
+    "image": "🖼️ Header image",
+    "resources": "📚 Related resources",
+    "freepik": "🖼️ Freepik lookup",
+}
 
 
 # Main UI
@@ -157,6 +81,22 @@ with st.sidebar:
         help="Specify the target word count range for your article"
     )
     
+    article_mode = st.radio(
+        "Article Mode:",
+        list(ARTICLE_MODES),
+        help="Section-parallel writes each outline section at the same time, which is much faster for long articles"
+    )
+    
+    hedge_images = st.checkbox(
+        "Hedge image sourcing",
+        help="If Freepik is slow, also start DALL-E and use whichever image arrives first (may cost an extra DALL-E image)"
+    )
+    
+    bypass_cache = st.checkbox(
+        "Bypass cache",
+        help="Always call the API, even if the same title and settings were generated before"
+    )
+    
     generate_button = st.button(
         "🚀 Generate Article",
         type="primary",
@@ -171,6 +111,142 @@ with st.sidebar:
     - Images are sourced from Freepik first (free), then DALL-E  
     - All content is AI-generated using GPT-4 Turbo
     """)
+    
+    with st.expander("🩺 Diagnostics"):
+        breakers = all_breakers()
+        if not breakers:
+            st.caption("No provider calls yet.")
+        for breaker in breakers:
+            snapshot = breaker.snapshot()
+            status = f"**{snapshot['name']}** circuit: `{snapshot['state']}`"
+            if snapshot["retry_in"] is not None:
+                status += f" (probing again in {snapshot['retry_in']:.0f}s)"
+            st.markdown(status)
+            st.caption(f"Consecutive failures: {snapshot['failures']}")
+            for at, old_state, new_state, reason in reversed(snapshot["transitions"]):
+                st.caption(f"{time.strftime('%H:%M:%S', time.localtime(at))} {old_state} → {new_state}: {reason}")
+        for limiter in all_limiters():
+            snapshot = limiter.snapshot()
+            st.markdown(f"**{snapshot['name']}** rate limit: {snapshot['queued']} queued")
+            st.caption(
+                f"{snapshot['requests']:.0f}/{snapshot['rpm']:.0f} requests and "
+                f"{snapshot['tokens']:,.0f}/{snapshot['tpm']:,.0f} tokens available; "
+                f"{snapshot['waited']} calls have waited"
+            )
+        for limit in all_adaptive_limits():
+            snapshot = limit.snapshot()
+            st.markdown(
+                f"**{snapshot['name']}** concurrency limit: {snapshot['limit']:.1f} "
+                f"({snapshot['in_flight']} in flight, {snapshot['queued']} waiting)"
+            )
+            for label, latency in snapshot["latency"].items():
+                st.caption(f"{label}: p50 {latency['p50']:.1f}s, p95 {latency['p95']:.1f}s")
+            if snapshot["last_decrease"]:
+                at, reason = snapshot["last_decrease"]
+                st.caption(f"{time.strftime('%H:%M:%S', time.localtime(at))} cut ({snapshot['decreases']} total): {reason}")
+        if hedge_counts["launched"]:
+            st.markdown(
+                f"**Image hedging:** {hedge_counts['launched']} races, "
+                f"DALL-E won {hedge_counts['dalle_won']}, Freepik won {hedge_counts['freepik_won']}"
+            )
+
+def finish_job(job):
+    """Store a finished job's results in session state, with the messages to show for it."""
+    results = job["results"] or {}
+    messages = [("error", f"{STAGE_ERRORS[stage]} error: {error}") for stage, error in job["errors"].items()]
+
+    if job["status"] == CANCELLED:
+        messages.append(("info", f"⏹️ Generation stopped. Saved roughly {job['tokens_saved'] or 0:,} completion tokens."))
+    elif job["error"]:
+        messages.append(("error", f"❌ Generation failed: {job['error']}"))
+    elif not results.get("outline"):
+        messages.append(("error", "❌ Failed to generate outline. Please try again."))
+    elif not results.get("article"):
+        messages.append(("error", "❌ Failed to generate article. The outline was saved; retry to write the article from it."))
+    else:
+        generated_content = {
+            'title': job["title"],
+            'outline': results["outline"],
+            'article': results["article"],
+        }
+
+        image_url, image_source = results.get("image") or (None, None)
+        if not image_url and not results.get("image_blob"):
+            messages.append(("warning", "⚠️ Could not generate header image."))
+        generated_content['image_url'] = image_url
+        generated_content['image_source'] = image_source
+        generated_content['image_candidates'] = results.get("image_candidates") or []
+        generated_content['image_index'] = 0
+        generated_content['image_blob'] = results.get("image_blob")
+        generated_content['trace_id'] = results.get("trace_id")
+
+        if results.get("resources"):
+            generated_content['resources'] = results["resources"]
+
+        st.session_state.generated_content = generated_content
+        if job["retries"]:
+            messages.append(("success", f"✅ Article generation complete! ({len(job['retries'])} transient errors retried)"))
+        else:
+            messages.append(("success", "✅ Article generation complete!"))
+
+    st.session_state.job_messages = messages
+    st.session_state.resume_job_id = job["id"] if job["failed"] else None
+    st.session_state.job_id = None
+    st.query_params.pop("job", None)
+
+
+def retry_failed_stages():
+    """Resume the last job, re-running only the stages that did not succeed."""
+    job = get_job_manager().resume(st.session_state.resume_job_id)
+    st.session_state.resume_job_id = None
+    if job is None:
+        st.session_state.job_messages = [("error", "❌ The saved progress for this article has expired. Please generate it again.")]
+        return
+    st.session_state.job_id = job.id
+    st.session_state.job_messages = []
+    st.query_params["job"] = job.id
+
+
+@st.fragment(run_every=0.5)
+def show_job_progress():
+    """Poll the running job and show its progress; hand over to the full page when it ends."""
+    job = get_job_manager().get(st.session_state.job_id)
+    if job is None:
+        # Expired, or the server restarted since the job was started.
+        if load_checkpoint(st.session_state.job_id):
+            st.session_state.resume_job_id = st.session_state.job_id
+            st.session_state.job_messages = [("warning", "⚠️ This generation was interrupted. Completed stages were saved and can be resumed.")]
+        st.session_state.job_id = None
+        st.query_params.pop("job", None)
+        st.rerun()
+
+    snapshot = job.snapshot()
+    if snapshot["status"] != RUNNING:
+        finish_job(snapshot)
+        st.rerun()
+
+    completed = snapshot["completed"]
+    st.button("⏹️ Stop", on_click=job.cancel, help="Cancel the remaining stages and stop spending tokens")
+    st.progress(int(100 * len(completed) / len(STAGES)))
+    running = [STAGE_LABELS[s] for s in STAGES if s not in completed]
+    if completed:
+        st.info(f"{STAGE_LABELS[completed[-1]]} done. Still working on: {', '.join(running)}... ({snapshot['elapsed']:.0f}s)")
+    else:
+        st.info(f"🚀 Generating outline, header image and resources... ({snapshot['elapsed']:.0f}s)")
+    if snapshot["queued"]:
+        model, position = snapshot["queued"]
+        st.caption(f"🚦 Waiting for the {model} rate limit: position {position} in the queue. Your request will start automatically.")
+    for stage, error in snapshot["errors"].items():
+        st.error(f"{STAGE_ERRORS[stage]} error: {error}")
+    if snapshot["retries"]:
+        label, attempt, delay, error = snapshot["retries"][-1]
+        st.caption(
+            f"⏳ {len(snapshot['retries'])} transient errors retried. Latest: "
+            f"{STAGE_LABELS.get(label, label)}, attempt {attempt + 1} after {delay:.0f}s ({error})"
+        )
+    if snapshot["article_text"]:
+        st.markdown(snapshot["article_text"])
+
 
 # Main content area
 if generate_button:
@@ -179,54 +255,74 @@ if generate_button:
     elif not openai.api_key:
         st.error("⚠️ OpenAI API key not found. Please set OPENAI_API_KEY in your environment variables.")
     else:
-        progress_bar = st.progress(0)
-        status_text = st.empty()
-        
-        generated_content = {}
-        
-        status_text.info("📋 Generating article outline...")
-        progress_bar.progress(20)
-        outline = generate_outline(title, word_range)
-        
-        if outline:
-            generated_content['outline'] = outline
-            progress_bar.progress(40)
-            
-            status_text.info("✍️ Writing full article...")
-            article = write_article(title, outline, word_range)
-            
-            if article:
-                generated_content['article'] = article
-                progress_bar.progress(60)
-                
-                status_text.info("🖼️ Searching for header image...")
-                image_url, image_source = generate_header_image(title)
-                
-                if image_url:
-                    generated_content['image_url'] = image_url
-                    generated_content['image_source'] = image_source
-                    progress_bar.progress(80)
-                else:
-                    st.warning("⚠️ Could not generate header image.")
-                    generated_content['image_url'] = None
-                    generated_content['image_source'] = None
-                
-                status_text.info("📚 Gathering related resources...")
-                resources = suggest_resources(title)
-                
-                if resources:
-                    generated_content['resources'] = resources
-                    progress_bar.progress(100)
-                
-                st.session_state.generated_content = generated_content
-                status_text.success("✅ Article generation complete!")
-            else:
-                st.error("❌ Failed to generate article. Please try again.")
-        else:
-            st.error("❌ Failed to generate outline. Please try again.")
-        
-        progress_bar.empty()
-        status_text.empty()
+        mode, stream = ARTICLE_MODES[article_mode]
+        job = get_job_manager().submit(
+            title,
+            word_range,
+            stream=stream,
+            article_mode=mode,
+            use_cache=not bypass_cache,
+            hedge_images=hedge_images
+        )
+        st.session_state.job_id = job.id
+        st.session_state.job_messages = []
+        st.session_state.resume_job_id = None
+        st.query_params["job"] = job.id
+
+if st.session_state.job_id:
+    show_job_progress()
+
+for kind, message in st.session_state.job_messages:
+    getattr(st, kind)(message)
+
+if st.session_state.resume_job_id and not st.session_state.job_id:
+    st.button(
+        "🔁 Retry failed stage",
+        on_click=retry_failed_stages,
+        help="Re-run only the stages that failed or did not finish, reusing everything already generated"
+    )
+
+def trace_waterfall(spans):
+    """Chart a trace's spans as a waterfall, children indented under their parents."""
+    children = {}
+    for span in spans:
+        children.setdefault(span["parent_id"], []).append(span)
+    roots = [s for s in spans if s["parent_id"] not in {other["span_id"] for other in spans}]
+    start = min(s["start"] for s in spans)
+    rows = []
+
+    def add(span, depth):
+        rows.append({
+            "span": f"{len(rows):03d} " + "\u2003" * depth + span["name"],
+            "start": span["start"] - start,
+            "end": (span["end"] or span["start"]) - start,
+            "duration": (span["end"] or span["start"]) - span["start"],
+            "status": span["status"].split(":")[0],
+            "details": ", ".join(f"{k}={v}" for k, v in span["attributes"].items()),
+        })
+        for child in children.get(span["span_id"], []):
+            add(child, depth + 1)
+
+    for root in roots:
+        add(root, 0)
+    frame = pd.DataFrame(rows)
+    return alt.Chart(frame).mark_bar().encode(
+        x=alt.X("start:Q", title="Seconds since start"),
+        x2="end:Q",
+        y=alt.Y("span:N", sort=None, title=None, axis=alt.Axis(labelExpr="substring(datum.label, 4)", labelLimit=400)),
+        color=alt.Color("status:N", scale=alt.Scale(domain=["ok", "error", "cancelled"], range=["#4c78a8", "#e45756", "#bab0ac"])),
+        tooltip=["span", alt.Tooltip("duration:Q", format=".2f"), "status", "details"],
+    ).properties(height=max(120, 22 * len(rows)))
+
+
+def next_image():
+    """Show the next cached header image candidate; no API calls."""
+    content = st.session_state.generated_content
+    candidates = content['image_candidates']
+    content['image_index'] = (content['image_index'] + 1) % len(candidates)
+    content['image_url'] = candidates[content['image_index']]
+    content['image_blob'] = store_image(content['image_url'])
+
 
 # Display generated content
 if st.session_state.generated_content:
@@ -240,13 +336,23 @@ if st.session_state.generated_content:
     st.markdown(content.get('article', 'No article generated.'))
     st.markdown("---")
     
-    if content.get('image_url'):
+    # Render the stored, downscaled copy; hot-link only if it is missing.
+    image = None
+    if content.get('image_blob'):
+        image = get_image_store().get(content['image_blob'])
+    if image or content.get('image_url'):
         st.markdown("### 🖼️ Header Image")
         st.image(
-            content['image_url'],
+            image or content['image_url'],
             caption=f"Header Image (Source: {content.get('image_source', 'Unknown')})",
-            width=700
+            width=DISPLAY_WIDTH
         )
+        candidates = content.get('image_candidates', [])
+        if len(candidates) > 1:
+            st.button(
+                f"🔄 Next image ({content['image_index'] + 1}/{len(candidates)})",
+                on_click=next_image
+            )
     else:
         st.markdown("### 🖼️ Header Image")
         st.info("No header image available.")
@@ -259,7 +365,7 @@ if st.session_state.generated_content:
     col1, col2 = st.columns(2)
     with col1:
         if st.button("📥 Download as Markdown"):
-            markdown_content = f"""# {title}
+            markdown_content = f"""# {content.get('title', title)}
 
 ## Outline
 {content.get('outline', '')}
@@ -273,11 +379,20 @@ if st.session_state.generated_content:
             st.download_button(
                 label="Download Markdown File",
                 data=markdown_content,
-                file_name=f"{title.replace(' ', '_')}.md",
+                file_name=f"{content.get('title', title).replace(' ', '_')}.md",
                 mime="text/markdown"
             )
     with col2:
         st.info("💡 PDF export coming soon!")
+    
+    if content.get('trace_id'):
+        with st.expander("⏱️ Generation Trace"):
+            spans = get_trace(content['trace_id'])
+            if spans:
+                st.altair_chart(trace_waterfall(spans), use_container_width=True)
+                st.caption(f"Trace `{content['trace_id']}`, {len(spans)} spans")
+            else:
+                st.caption("This trace is no longer available.")
 
 st.markdown("---")
 st.markdown(
@@ -0,0 +1,174 @@
+"""Headless batch generation over a JSONL file of titles.
+
+    python batch.py titles.jsonl results.jsonl --workers 8
+
+Each input line is a record like {"title": "...", "word_range": "800-1000"}.
+The full outline/article/image/resources pipeline runs for every title and
+one result record per title is appended to the output file as soon as it
+finishes. Titles that already have a successful record in the output are
+skipped, so an interrupted run is resumed by running the same command again.
+"""
+import argparse
+import asyncio
+import json
+import sys
+from collections import Counter
+
+import openai
+from dotenv import load_dotenv
+
+# Project modules read their settings when imported, so load .env first.
+load_dotenv()
+
+from aimd import all_adaptive_limits
+from images import get_image_store
+from pipeline import ARTICLE_MODES, arun_stages, run_sync
+
+
+def load_rows(path, default_word_range):
+    """Read {title, word_range} records, dropping blanks, bad lines and repeated titles."""
+    rows, seen = [], set()
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"line {number}: invalid JSON ({e.msg}), skipped", file=sys.stderr)
+                continue
+            if not isinstance(record, dict):
+                print(f"line {number}: not a JSON object, skipped", file=sys.stderr)
+                continue
+            title = str(record.get("title") or "").strip()
+            if not title:
+                print(f"line {number}: missing title, skipped", file=sys.stderr)
+                continue
+            if title in seen:
+                continue
+            seen.add(title)
+            rows.append((title, str(record.get("word_range") or default_word_range)))
+    return rows
+
+
+def load_done(path):
+    """Return the titles that already have a successful record in the output file."""
+    done = set()
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A run killed mid-write can leave a truncated last line.
+                    continue
+                if record.get("status") == "ok":
+                    done.add(record["title"])
+    except FileNotFoundError:
+        pass
+    return done
+
+
+async def agenerate_record(title, word_range, article_mode="single", use_cache=True, hedge_images=False):
+    """Run the pipeline for one title and return its result record."""
+    errors = {}
+    retries = Counter()
+
+    def on_event(stage, result, error):
+        if error is not None:
+            errors[stage] = str(error)
+
+    def on_retry(label, attempt, delay, error):
+        retries[label] += 1
+
+    results = await arun_stages(
+        title,
+        word_range,
+        on_event=on_event,
+        article_mode=article_mode,
+        use_cache=use_cache,
+        on_retry=on_retry,
+        hedge_images=hedge_images
+    )
+    image_url, image_source = results.get("image") or (None, None)
+    image_blob = results.get("image_blob")
+    return {
+        "title": title,
+        "word_range": word_range,
+        "status": "ok" if results.get("outline") and results.get("article") else "failed",
+        "outline": results.get("outline"),
+        "article": results.get("article"),
+        "image_url": image_url,
+        "image_source": image_source,
+        "image_candidates": results.get("image_candidates") or [],
+        "image_file": get_image_store().path(image_blob) if image_blob else None,
+        "resources": results.get("resources"),
+        "errors": errors,
+        "retries": dict(retries),
+        "trace_id": results.get("trace_id"),
+    }
+
+
+def format_limits():
+    """Current adaptive concurrency limits, e.g. "openai limit 9.1, 3 in flight"."""
+    return "; ".join(
+        f"{s['name']} limit {s['limit']:.1f}, {s['in_flight']} in flight"
+        for s in (limit.snapshot() for limit in all_adaptive_limits())
+    )
+
+
+async def arun_batch(rows, output_path, workers, article_mode="single", use_cache=True, hedge_images=False):
+    """Generate every row with at most ``workers`` articles in flight.
+
+    Upstream calls within those articles are further limited per provider by
+    the adaptive limits in aimd.py. Returns the number of titles that failed.
+    """
+    limit = asyncio.Semaphore(workers)
+    failed = 0
+
+    with open(output_path, "a", encoding="utf-8") as out:
+        async def run(index, title, word_range):
+            nonlocal failed
+            async with limit:
+                record = await agenerate_record(title, word_range, article_mode, use_cache, hedge_images)
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            if record["status"] != "ok":
+                failed += 1
+            print(f"[{index}/{len(rows)}] {record['status']}: {title} ({format_limits()})", file=sys.stderr)
+
+        await asyncio.gather(*(run(i, *row) for i, row in enumerate(rows, 1)))
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate articles for every title in a JSONL file.")
+    parser.add_argument("input", help="JSONL file of {title, word_range} records")
+    parser.add_argument("output", help="JSONL file to append result records to")
+    parser.add_argument("--workers", type=int, default=4, help="articles generated concurrently (default: 4)")
+    parser.add_argument("--mode", choices=ARTICLE_MODES, default="single", help="article writing mode (default: single)")
+    parser.add_argument("--hedge-images", action="store_true", help="start DALL-E alongside a slow Freepik lookup")
+    parser.add_argument("--no-cache", action="store_true", help="ignore cached LLM responses")
+    parser.add_argument("--word-range", default="800-1000", help="word range for records that omit one")
+    args = parser.parse_args(argv)
+
+    if not openai.api_key:
+        parser.error("OpenAI API key not found. Please set OPENAI_API_KEY in your environment variables.")
+
+    done = load_done(args.output)
+    rows = [row for row in load_rows(args.input, args.word_range) if row[0] not in done]
+    print(f"{len(done)} titles already done, {len(rows)} to generate", file=sys.stderr)
+
+    failed = run_sync(arun_batch(
+        rows,
+        args.output,
+        max(1, args.workers),
+        args.mode,
+        not args.no_cache,
+        args.hedge_images
+    ))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
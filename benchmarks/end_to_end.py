@@ -0,0 +1,295 @@
+"""End-to-end throughput and latency of the full pipeline against the mock providers.
+
+    python -m benchmarks.end_to_end --concurrency 1,4,16 --word-ranges 500-700,1500-2000 \\
+        --articles 16 --output results.json -- --tokens-per-second 400 --image-latency-ms 2000
+
+Starts benchmarks/mock_providers.py in a subprocess (arguments after ``--``
+are passed to it) and, for every concurrency level and word range, generates
+--articles articles with at most that many in flight. The response cache is
+bypassed and every title is unique, so each article makes its own upstream
+calls. For each run it reports articles per minute, p50/p95/p99 of every
+stage and of whole articles (from the generation traces), the process's
+peak RSS, and CPU seconds per article. The mocks run in their own process,
+so their CPU and memory are not counted.
+
+The full report, with the commit, mock settings and every latency, is
+written as JSON to --output; pass an earlier report as --baseline to print
+the change in throughput and p95 per run. Settings from the environment
+or .env are overridden so runs are comparable: the cache and image store
+use a temporary directory, traces stay in memory, and the shared rate
+limits are off so they do not dominate the results. Pass --rate-limits to
+keep the configured OPENAI_RPM/OPENAI_TPM instead.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+
+from dotenv import load_dotenv
+
+# Project modules read their settings when imported, so load .env first.
+load_dotenv()
+
+from aimd import percentile
+
+PERCENTILES = (0.5, 0.95, 0.99)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", default="1,4,16", help="comma-separated articles in flight (default: 1,4,16)")
+    parser.add_argument("--word-ranges", default="500-700,1500-2000", help="comma-separated word ranges (default: 500-700,1500-2000)")
+    parser.add_argument("--articles", type=int, default=16, help="articles per run (default: 16)")
+    parser.add_argument("--mode", choices=("single", "sections"), default="single", help="article writing mode (default: single)")
+    parser.add_argument("--output", default="end_to_end.json", help="JSON report path (default: end_to_end.json)")
+    parser.add_argument("--baseline", help="earlier JSON report to compare against")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the configured OPENAI_RPM/OPENAI_TPM limits")
+    parser.add_argument("mock_args", nargs=argparse.REMAINDER, help="arguments for benchmarks.mock_providers, after --")
+    args = parser.parse_args(argv)
+    if args.mock_args[:1] == ["--"]:
+        args.mock_args = args.mock_args[1:]
+    return args
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_mocks(mock_args):
+    """Run the mock providers in a subprocess and return it with its base URL."""
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.mock_providers", *mock_args, "--host", "127.0.0.1", "--port", str(port)],
+        stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, f"http://127.0.0.1:{port}"
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise SystemExit("mock providers did not start")
+            time.sleep(0.1)
+
+
+def rss_bytes():
+    """Current resident set size, or None where /proc is unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+class PeakRss:
+    """Samples RSS on a thread while a run is in progress and keeps the peak.
+
+    Falls back to the process-lifetime peak from getrusage without /proc.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = rss_bytes() or 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="rss-sampler", daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss_bytes() or 0)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        if not self.peak:
+            scale = 1 if sys.platform == "darwin" else 1024
+            self.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def summarize(latencies):
+    if not latencies:
+        return None
+    return {f"p{round(p * 100)}": round(percentile(latencies, p), 4) for p in PERCENTILES} | {"count": len(latencies)}
+
+
+async def arun_cell(concurrency, word_range, articles, mode):
+    """Generate ``articles`` articles, at most ``concurrency`` at a time; return the raw timings."""
+    from pipeline import STAGES, arun_stages
+    from tracing import get_trace
+
+    limit = asyncio.Semaphore(concurrency)
+    run_id = uuid.uuid4().hex[:8]
+    stage_latencies = {stage: [] for stage in STAGES}
+    totals = []
+    outcomes = Counter()
+    retries = Counter()
+
+    def on_retry(label, attempt, delay, error):
+        retries[label] += 1
+
+    async def generate(n):
+        async with limit:
+            results = await arun_stages(
+                f"Benchmark article {run_id}-{n} about cave life",
+                word_range,
+                article_mode=mode,
+                use_cache=False,
+                on_retry=on_retry
+            )
+        # Read the spans right away, before newer traces push them out of memory.
+        spans = get_trace(results["trace_id"])
+        root = next(s for s in spans if s["parent_id"] is None)
+        totals.append(root["end"] - root["start"])
+        for s in spans:
+            if s["parent_id"] == root["span_id"] and s["name"] in stage_latencies and s["status"] == "ok":
+                stage_latencies[s["name"]].append(s["end"] - s["start"])
+        outcomes["ok" if results.get("outline") and results.get("article") else "failed"] += 1
+
+    await asyncio.gather(*(generate(n) for n in range(articles)))
+    return stage_latencies, totals, outcomes, retries
+
+
+def run_cell(concurrency, word_range, articles, mode):
+    from pipeline import run_sync
+
+    baseline_rss = rss_bytes()
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    with PeakRss() as rss:
+        stage_latencies, totals, outcomes, retries = run_sync(arun_cell(concurrency, word_range, articles, mode))
+    wall = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    return {
+        "concurrency": concurrency,
+        "word_range": word_range,
+        "articles": articles,
+        "ok": outcomes["ok"],
+        "failed": outcomes["failed"],
+        "retries": dict(retries),
+        "wall_seconds": round(wall, 3),
+        "articles_per_minute": round(outcomes["ok"] / wall * 60, 3),
+        "article_latency": summarize(totals),
+        "stage_latency": {stage: summarize(values) for stage, values in stage_latencies.items()},
+        "peak_rss_mb": round(rss.peak / 2**20, 1),
+        "rss_growth_mb": round((rss.peak - baseline_rss) / 2**20, 1) if baseline_rss else None,
+        "cpu_seconds_per_article": round(cpu / articles, 4),
+    }
+
+
+def format_cell(cell):
+    stages = "  ".join(
+        f"{stage} {s['p50']:.2f}/{s['p95']:.2f}/{s['p99']:.2f}"
+        for stage, s in cell["stage_latency"].items() if s
+    )
+    article = cell["article_latency"] or {"p50": 0, "p95": 0, "p99": 0}
+    return (
+        f"c={cell['concurrency']:<3} words={cell['word_range']:<10} "
+        f"{cell['articles_per_minute']:7.1f} articles/min  "
+        f"article p50/p95/p99 {article['p50']:.2f}/{article['p95']:.2f}/{article['p99']:.2f}s  "
+        f"peak RSS {cell['peak_rss_mb']:.0f} MB  CPU {cell['cpu_seconds_per_article'] * 1000:.0f} ms/article  "
+        f"ok {cell['ok']}/{cell['articles']}\n      {stages}"
+    )
+
+
+def compare(report, baseline):
+    """Lines with the change in throughput and article p95 for every run also in ``baseline``."""
+    before = {(c["concurrency"], c["word_range"]): c for c in baseline["cells"]}
+    lines = []
+    for cell in report["cells"]:
+        old = before.get((cell["concurrency"], cell["word_range"]))
+        if not old or not old["articles_per_minute"] or not (old["article_latency"] and cell["article_latency"]):
+            continue
+        throughput = cell["articles_per_minute"] / old["articles_per_minute"] - 1
+        p95 = cell["article_latency"]["p95"] / old["article_latency"]["p95"] - 1
+        lines.append(
+            f"c={cell['concurrency']:<3} words={cell['word_range']:<10} "
+            f"articles/min {throughput:+.1%}  article p95 {p95:+.1%}"
+        )
+    return lines
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    concurrency_levels = [int(c) for c in args.concurrency.split(",")]
+    word_ranges = [w.strip() for w in args.word_ranges.split(",")]
+
+    mocks, base_url = start_mocks(args.mock_args)
+    workdir = tempfile.mkdtemp(prefix="end_to_end-")
+    os.environ.update({
+        "OPENAI_BASE_URL": f"{base_url}/v1",
+        "FREEPIK_API_URL": f"{base_url}/v1/resources",
+        "OPENAI_API_KEY": "benchmark",
+        "FREEPIK_API_KEY": "benchmark",
+        "METRICS_PORT": "0",
+        "OPENAI_VERSION": "mock-gpt",
+        "LLM_CACHE_PATH": os.path.join(workdir, "llm_cache.sqlite3"),
+        "IMAGE_STORE_PATH": os.path.join(workdir, "images"),
+        "TRACE_PATH": "",
+    })
+    if not args.rate_limits:
+        # Per-model overrides for the models used would win over OPENAI_*, so clear those too.
+        for prefix in ("OPENAI", "MOCK_GPT", "DALL_E_3"):
+            os.environ[f"{prefix}_RPM"] = os.environ[f"{prefix}_TPM"] = "0"
+
+    report = {
+        "benchmark": "end_to_end",
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "mode": args.mode,
+        "rate_limits": args.rate_limits,
+        "mock_args": args.mock_args,
+        "cells": [],
+    }
+    try:
+        for word_range in word_ranges:
+            for concurrency in concurrency_levels:
+                cell = run_cell(concurrency, word_range, args.articles, args.mode)
+                report["cells"].append(cell)
+                print(format_cell(cell), file=sys.stderr)
+    finally:
+        mocks.terminate()
+        mocks.wait()
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"Compared with {args.baseline} ({baseline.get('commit') or 'unknown commit'}):", file=sys.stderr)
+        for line in compare(report, baseline):
+            print(f"  {line}", file=sys.stderr)
+    return 1 if any(cell["failed"] for cell in report["cells"]) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""Cold versus pooled Freepik lookup latency against a local stand-in server.
+
+    python -m benchmarks.freepik_pool --requests 200 --connect-delay-ms 30
+
+The stand-in server answers /v1/resources with a fixed Freepik-shaped
+payload and sleeps for --connect-delay-ms whenever a new connection is
+accepted, standing in for the TCP+TLS handshake to api.freepik.com. "cold"
+issues a bare requests.get per lookup, as the app used to; "pooled" goes
+through pipeline.aget_freepik_image and its keep-alive session, with the
+response cache bypassed (and kept in a temporary directory) so every lookup
+makes the HTTP request.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+PAYLOAD = json.dumps({
+    "data": [{"attributes": {"preview": {"url": "https://img.example/preview.jpg"}}}]
+}).encode("utf-8")
+
+
+def start_server(connect_delay):
+    """Start the stand-in server on a free port and return it."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body go out in separate writes; without this, Nagle plus
+        # delayed ACKs add ~40 ms to every response on a kept-alive connection.
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            time.sleep(connect_delay)
+            super().setup()
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(PAYLOAD)))
+            self.end_headers()
+            self.wfile.write(PAYLOAD)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def measure(lookup, count):
+    """Time ``count`` sequential lookups and return the latencies in milliseconds."""
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        lookup()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def summarize(name, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(0.95 * (len(latencies) - 1))]
+    return f"{name:<7} mean {statistics.mean(latencies):7.2f} ms   p50 {statistics.median(latencies):7.2f} ms   p95 {p95:7.2f} ms"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=100, help="lookups per mode (default: 100)")
+    parser.add_argument("--connect-delay-ms", type=float, default=30, help="simulated handshake cost per new connection (default: 30)")
+    args = parser.parse_args(argv)
+
+    server = start_server(args.connect_delay_ms / 1000)
+    url = f"http://127.0.0.1:{server.server_port}/v1/resources"
+    os.environ["FREEPIK_API_URL"] = url
+    os.environ["FREEPIK_API_KEY"] = "benchmark"
+    os.environ["LLM_CACHE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="freepik_pool-"), "llm_cache.sqlite3")
+
+    import pipeline
+
+    async def pooled_lookup():
+        # Runs as its own task on the pipeline loop, so this only affects this lookup.
+        pipeline._use_cache.set(False)
+        return await pipeline.aget_freepik_image("benchmark")
+
+    headers = {"Authorization": "Bearer benchmark"}
+    params = {"term": "benchmark", "limit": 1, "filters[content_type]": "photo"}
+
+    cold = measure(lambda: requests.get(url, headers=headers, params=params, timeout=10), args.requests)
+    pooled = measure(lambda: pipeline.run_sync(pooled_lookup()), args.requests)
+
+    print(f"{args.requests} lookups per mode, {args.connect_delay_ms:g} ms simulated handshake")
+    print(summarize("cold", cold))
+    print(summarize("pooled", pooled))
+    server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
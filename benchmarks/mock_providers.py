@@ -0,0 +1,261 @@
+"""Local stand-in for the OpenAI and Freepik APIs, for load tests and benchmarks.
+
+    python -m benchmarks.mock_providers --port 8800 --tokens-per-second 80
+
+then point the app (or batch.py) at it:
+
+    OPENAI_BASE_URL=http://127.0.0.1:8800/v1 OPENAI_API_KEY=mock OPENAI_VERSION=mock-gpt \\
+    FREEPIK_API_URL=http://127.0.0.1:8800/v1/resources FREEPIK_API_KEY=mock \\
+    streamlit run app.py
+
+It serves the request and response shapes the app uses:
+/v1/chat/completions (plain and streamed as server-sent events, with usage),
+/v1/images/generations (url and b64_json), Freepik's /v1/resources, and the
+images those URLs point to. Response latency is log-normal around the given
+medians, chat output is produced at --tokens-per-second after the first-token
+latency, and a share of requests can fail with 429s (with Retry-After) or
+500s. Outline prompts get a markdown outline and every other chat prompt gets
+roughly the number of words it asks for, so section-parallel mode works too.
+"""
+import argparse
+import base64
+import io
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+
+TOKENS_PER_WORD = 1.35
+WORDS = (
+    "the caveman method turns slow careful thinking into clear practical writing for every reader "
+    "with examples data and honest tradeoffs that teams can apply today across products and markets"
+).split()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800, help="0 picks a free port (default: 8800)")
+    parser.add_argument("--chat-latency-ms", type=float, default=600, help="median time to first token (default: 600)")
+    parser.add_argument("--tokens-per-second", type=float, default=80, help="chat output rate (default: 80)")
+    parser.add_argument("--image-latency-ms", type=float, default=8000, help="median DALL-E latency (default: 8000)")
+    parser.add_argument("--freepik-latency-ms", type=float, default=300, help="median Freepik latency (default: 300)")
+    parser.add_argument("--latency-sigma", type=float, default=0.4, help="log-normal spread of all latencies (default: 0.4)")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests answered with 429 (default: 0)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 500 (default: 0)")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with 429s (default: 1)")
+    parser.add_argument("--freepik-results", type=int, default=10, help="images per Freepik search, 0 for none (default: 10)")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for reproducible runs")
+    return parser.parse_args(argv)
+
+
+def _image_bytes(image_format):
+    image = Image.linear_gradient("L").resize((1024, 1024)).convert("RGB")
+    out = io.BytesIO()
+    image.save(out, format=image_format)
+    return out.getvalue()
+
+
+def target_words(prompt):
+    """How many words a chat prompt asks for ("approximately 800-1000", "about 250")."""
+    match = re.search(r"(?:approximately|about)\s+(\d[\d,]*)(?:\s*(?:-|to)\s*(\d[\d,]*))?", prompt)
+    if not match:
+        return 300
+    numbers = [int(n.replace(",", "")) for n in match.groups() if n]
+    return sum(numbers) // len(numbers)
+
+
+def completion_text(prompt, rng):
+    """Mock output shaped like what the prompt asks for."""
+    if prompt.startswith("Create a detailed, structured outline"):
+        sections = ["Introduction"] + [f"Key Idea {n}" for n in range(1, 6)] + ["Conclusion"]
+        return "\n".join(f"## {s}\n- {' '.join(rng.choices(WORDS, k=8))}\n- {' '.join(rng.choices(WORDS, k=8))}" for s in sections)
+    if prompt.startswith("Provide 5 authoritative"):
+        return "\n".join(f"{n}. **Resource {n}** - {' '.join(rng.choices(WORDS, k=20))}" for n in range(1, 6))
+    words = rng.choices(WORDS, k=target_words(prompt))
+    paragraphs = [" ".join(words[i:i + 80]).capitalize() + "." for i in range(0, len(words), 80)]
+    return "\n\n".join(paragraphs)
+
+
+def start_server(options):
+    """Start the mock on a daemon thread and return the server; its port is ``server.server_port``."""
+    rng = random.Random(options.seed)
+    rng_lock = threading.Lock()
+    jpeg = _image_bytes("JPEG")
+    png_b64 = base64.b64encode(_image_bytes("PNG")).decode("ascii")
+
+    def draw(fn, *args):
+        with rng_lock:
+            return fn(*args)
+
+    def latency(median_ms):
+        if median_ms <= 0:
+            return 0.0
+        return draw(rng.lognormvariate, math.log(median_ms / 1000), options.latency_sigma)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, payload, status=200, headers=None):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def injected_failure(self):
+            """Answer with a 429 or 500 for the configured share of requests; return whether it did."""
+            roll = draw(rng.random)
+            if roll < options.rate_limit_rate:
+                self.send_json(
+                    {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}},
+                    status=429,
+                    headers={"Retry-After": f"{options.retry_after:g}"}
+                )
+                return True
+            if roll < options.rate_limit_rate + options.error_rate:
+                self.send_json({"error": {"message": "Internal error (mock)", "type": "server_error"}}, status=500)
+                return True
+            return False
+
+        def read_json(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def base_url(self):
+            return f"http://{self.headers.get('Host') or f'{options.host}:{self.server.server_port}'}"
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/v1/resources":
+                time.sleep(latency(options.freepik_latency_ms))
+                if self.injected_failure():
+                    return
+                query = parse_qs(url.query)
+                limit = min(int(query.get("limit", ["1"])[0]), options.freepik_results)
+                term = query.get("term", [""])[0]
+                data = [
+                    {"attributes": {"preview": {"url": f"{self.base_url()}/images/{abs(hash(term)) % 1000}-{n}.jpg"}}}
+                    for n in range(limit)
+                ]
+                self.send_json({"data": data})
+            elif url.path.startswith("/images/"):
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(jpeg)))
+                self.end_headers()
+                self.wfile.write(jpeg)
+            else:
+                self.send_json({"error": {"message": f"Unknown path {url.path}"}}, status=404)
+
+        def do_POST(self):
+            path = urlparse(self.path).path
+            request = self.read_json()
+            if path.endswith("/chat/completions"):
+                self.chat(request)
+            elif path.endswith("/images/generations"):
+                time.sleep(latency(options.image_latency_ms))
+                if self.injected_failure():
+                    return
+                if request.get("response_format") == "b64_json":
+                    item = {"b64_json": png_b64}
+                else:
+                    item = {"url": f"{self.base_url()}/images/dalle-{draw(rng.randrange, 10**6)}.jpg"}
+                self.send_json({"created": int(time.time()), "data": [item]})
+            else:
+                self.send_json({"error": {"message": f"Unknown path {path}"}}, status=404)
+
+        def chat(self, request):
+            time.sleep(latency(options.chat_latency_ms))
+            if self.injected_failure():
+                return
+            prompt = "\n".join(m.get("content") or "" for m in request.get("messages", []))
+            text = draw(completion_text, prompt, rng)
+            words = text.split(" ")
+            usage = {
+                "prompt_tokens": len(prompt) // 4,
+                "completion_tokens": int(len(words) * TOKENS_PER_WORD),
+            }
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            base = {"id": f"chatcmpl-mock{draw(rng.randrange, 10**9)}", "created": int(time.time()), "model": request.get("model") or "mock"}
+
+            if not request.get("stream"):
+                time.sleep(usage["completion_tokens"] / options.tokens_per_second)
+                self.send_json({
+                    **base,
+                    "object": "chat.completion",
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                    "usage": usage,
+                })
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            started = time.monotonic()
+            seconds_per_word = TOKENS_PER_WORD / options.tokens_per_second
+            try:
+                for i, word in enumerate(words):
+                    # Pace against the start time so sleep overhead does not accumulate.
+                    delay = started + i * seconds_per_word - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    self.send_event({
+                        **base,
+                        "object": "chat.completion.chunk",
+                        "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}],
+                    })
+                self.send_event({**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+                if (request.get("stream_options") or {}).get("include_usage"):
+                    self.send_event({**base, "object": "chat.completion.chunk", "choices": [], "usage": usage})
+                self.send_chunk(b"data: [DONE]\n\n")
+                self.send_chunk(b"")
+            except (BrokenPipeError, ConnectionResetError):
+                # The client closed the stream, e.g. a cancelled generation.
+                self.close_connection = True
+
+        def send_event(self, payload):
+            self.send_chunk(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+
+        def send_chunk(self, data):
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+    server = ThreadingHTTPServer((options.host, options.port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-providers", daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    server = start_server(options)
+    base = f"http://{options.host}:{server.server_port}"
+    print(f"Mock providers listening on {base}", file=sys.stderr)
+    print(f"  OPENAI_BASE_URL={base}/v1", file=sys.stderr)
+    print(f"  FREEPIK_API_URL={base}/v1/resources", file=sys.stderr)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
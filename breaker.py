@@ -0,0 +1,129 @@
+"""Per-provider circuit breakers.
+
+A breaker starts closed. After ``failure_threshold`` consecutive failures it
+opens and calls fail fast with CircuitOpenError. Once ``reset_timeout``
+seconds have passed it goes half-open and lets a single probe call through:
+success closes it again, failure re-opens it for another timeout.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider whose breaker is open."""
+
+
+class CircuitBreaker:
+    """Thread-safe closed/open/half-open breaker with a short transition history."""
+
+    def __init__(self, name, failure_threshold=3, reset_timeout=30.0, history=20):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.transitions = deque(maxlen=history)
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _move(self, state, reason):
+        self.transitions.append((time.time(), self.state, state, reason))
+        self.state = state
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+
+    def allow(self):
+        """Whether a call may go through now. In half-open, only one probe at a time is allowed."""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._move(HALF_OPEN, "reset timeout elapsed, probing")
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._probing = False
+            self.failures = 0
+            if self.state != CLOSED:
+                self._move(CLOSED, "probe succeeded")
+
+    def record_failure(self, error):
+        with self._lock:
+            self._probing = False
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                self._move(OPEN, f"probe failed: {error}")
+            elif self.state == CLOSED and self.failures >= self.failure_threshold:
+                self._move(OPEN, f"{self.failures} consecutive failures, last: {error}")
+
+    def release(self):
+        """Give up a call without a verdict, e.g. when it was cancelled."""
+        with self._lock:
+            self._probing = False
+
+    async def acall(self, fn):
+        """Await ``fn()`` through the breaker, raising CircuitOpenError if it is open."""
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} circuit is open")
+        try:
+            result = await fn()
+        except Exception as e:
+            self.record_failure(e)
+            raise
+        except BaseException:
+            self.release()
+            raise
+        self.record_success()
+        return result
+
+    def snapshot(self):
+        """Current state as a plain dict, for display."""
+        with self._lock:
+            retry_in = None
+            if self.state == OPEN:
+                retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+            return {
+                "name": self.name,
+                "state": self.state,
+                "failures": self.failures,
+                "retry_in": retry_in,
+                "transitions": list(self.transitions),
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    """Return the process-wide breaker for provider ``name``.
+
+    Thresholds come from ``<NAME>_BREAKER_FAILURES`` and
+    ``<NAME>_BREAKER_RESET`` (seconds).
+    """
+    with _breakers_lock:
+        if name not in _breakers:
+            prefix = name.upper()
+            _breakers[name] = CircuitBreaker(
+                name,
+                failure_threshold=int(os.getenv(f"{prefix}_BREAKER_FAILURES", "3")),
+                reset_timeout=float(os.getenv(f"{prefix}_BREAKER_RESET", "30"))
+            )
+        return _breakers[name]
+
+
+def all_breakers():
+    """Every breaker created so far."""
+    with _breakers_lock:
+        return list(_breakers.values())
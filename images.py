@@ -0,0 +1,111 @@
+"""Local, content-addressed store for header images.
+
+Images are downloaded once, downscaled to the display width and re-encoded
+before being stored under the SHA-256 of their bytes. Rendering from the
+store avoids hot-linking full-size remote images on every rerun and keeps
+working after DALL-E URLs expire. The store has a size budget; the least
+recently used files are deleted first when it is exceeded.
+"""
+import hashlib
+import io
+import os
+import threading
+
+from PIL import Image
+
+DISPLAY_WIDTH = 700
+
+IMAGE_STORE_PATH = os.getenv("IMAGE_STORE_PATH", os.path.join(".cache", "images"))
+IMAGE_STORE_MAX_BYTES = int(float(os.getenv("IMAGE_STORE_MAX_MB", "500")) * 1024 * 1024)
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "WEBP").upper()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+
+
+def downscale(data, width=DISPLAY_WIDTH, image_format=IMAGE_FORMAT, quality=IMAGE_QUALITY):
+    """Shrink encoded image bytes to at most ``width`` pixels wide and re-encode them."""
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        if image.width > width:
+            image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+        if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        out = io.BytesIO()
+        image.save(out, format=image_format, quality=quality)
+        return out.getvalue()
+
+
+class BlobStore:
+    """Files named by the SHA-256 of their contents, with LRU eviction by total size."""
+
+    def __init__(self, root=IMAGE_STORE_PATH, max_bytes=IMAGE_STORE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, digest):
+        """Filesystem path of the blob for ``digest``."""
+        return os.path.join(self.root, digest)
+
+    def has(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def put(self, data):
+        """Store ``data`` and return its digest."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        with self._lock:
+            if os.path.exists(path):
+                os.utime(path)
+                return digest
+            # Write then rename so readers in other processes never see a partial file.
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            self._evict(keep=digest)
+        return digest
+
+    def get(self, digest):
+        """Return the stored bytes for ``digest``, or None if missing or evicted."""
+        path = self.path(digest)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # Modification time doubles as the last-used time for eviction.
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def _evict(self, keep):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.root):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+                total += stat.st_size
+        for _, name, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_image_store():
+    """Return the process-wide image store."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = BlobStore()
+    return _store
@@ -0,0 +1,259 @@
+"""Background generation jobs that outlive Streamlit reruns.
+
+Each job runs arun_stages on the shared event loop and records its progress
+on a Job object. The JobManager is held in st.cache_resource, so the UI can
+poll a job by ID from any rerun, or from a new session after a page refresh.
+
+Every job's inputs and finished stage outputs are also checkpointed to the
+on-disk cache under its ID, so a job that partly failed, was stopped, or was
+lost to a server restart can be resumed without paying for the stages that
+already succeeded.
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+import streamlit as st
+
+from cache import cache_key, get_cache
+from metrics import cancel_tokens_saved, jobs_cancelled
+from pipeline import STAGES, arun_stages, estimate_completion_tokens, get_event_loop, stage_succeeded
+from ratelimit import queue_position
+
+logger = logging.getLogger(__name__)
+
+# How long finished jobs are kept around for a refreshed page to pick up
+JOB_RETENTION = float(os.getenv("JOB_RETENTION_MINUTES", "60")) * 60
+# How long a job's checkpoint stays resumable
+CHECKPOINT_TTL = float(os.getenv("CHECKPOINT_TTL_HOURS", "24")) * 3600
+
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+def checkpoint_key(job_id):
+    return cache_key("checkpoint", job_id)
+
+
+def load_checkpoint(job_id):
+    """Return the saved inputs and partial results of job ``job_id``, or None."""
+    raw = get_cache().get(checkpoint_key(job_id))
+    if raw is None:
+        return None
+    state = json.loads(raw)
+    if state["results"].get("image"):
+        state["results"]["image"] = tuple(state["results"]["image"])
+    return state
+
+
+class Job:
+    """State of one generation, updated from the event loop and read by the UI."""
+
+    def __init__(self, title, word_range, options, stream=False, job_id=None, results=None):
+        self.id = job_id or uuid.uuid4().hex[:12]
+        self.title = title
+        self.word_range = word_range
+        self.options = options
+        self.stream = stream
+        # Filled in place by arun_stages as stages finish
+        self.partial = dict(results or {})
+        self.status = RUNNING
+        self.completed = []
+        self.errors = {}
+        self.retries = []
+        self.article_text = ""
+        self.streamed_chunks = 0
+        self.tokens_saved = None
+        self.results = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.future = None
+        self._lock = threading.Lock()
+        self._checkpoint_lock = threading.Lock()
+        self._checkpoint_seq = 0
+        self._saved_seq = -1
+
+    def _checkpoint(self):
+        """Serialise the job's inputs and results so far; call on the loop thread."""
+        return json.dumps({
+            "title": self.title,
+            "word_range": self.word_range,
+            "stream": self.stream,
+            "options": self.options,
+            "results": self.partial,
+        })
+
+    def _save_checkpoint(self, seq, payload):
+        # Writes run on worker threads and may finish out of order; never let
+        # an older checkpoint overwrite a newer one.
+        with self._checkpoint_lock:
+            if seq <= self._saved_seq:
+                return
+            try:
+                get_cache().set(checkpoint_key(self.id), payload, CHECKPOINT_TTL)
+            except Exception:
+                logger.exception("Could not checkpoint job %s", self.id)
+                return
+            self._saved_seq = seq
+
+    def _on_event(self, stage, result, error):
+        with self._lock:
+            self.completed.append(stage)
+            if error is not None:
+                self.errors[stage] = str(error)
+            self._checkpoint_seq += 1
+            seq = self._checkpoint_seq
+        asyncio.get_running_loop().run_in_executor(None, self._save_checkpoint, seq, self._checkpoint())
+
+    def _on_delta(self, chunk):
+        with self._lock:
+            self.article_text += chunk
+            # Streamed chunks are almost always one token each.
+            self.streamed_chunks += 1
+
+    def _on_retry(self, label, attempt, delay, error):
+        with self._lock:
+            self.retries.append((label, attempt, delay, str(error)))
+
+    def _finish(self, future):
+        with self._lock:
+            self.finished_at = time.time()
+            if future.cancelled():
+                self.status = CANCELLED
+            elif future.exception() is not None:
+                self.status, self.error = FAILED, str(future.exception())
+            else:
+                self.status, self.results = DONE, future.result()
+
+    def cancel(self):
+        """Stop the job and every stage still in flight.
+
+        Cancellation propagates through each stage's awaits, so pending
+        requests are dropped and an active article stream is closed. Returns
+        the estimated completion tokens saved, or None if the job had
+        already ended.
+        """
+        with self._lock:
+            if self.status != RUNNING:
+                return None
+            pending = [s for s in ("outline", "article", "resources") if s not in self.completed]
+            saved = sum(estimate_completion_tokens(s, self.word_range) for s in pending)
+            if "article" in pending:
+                saved = max(0, saved - self.streamed_chunks)
+            self.tokens_saved = saved
+        self.future.cancel()
+        jobs_cancelled.inc()
+        cancel_tokens_saved.inc(value=saved)
+        return saved
+
+    def snapshot(self):
+        """A consistent copy of the job's state, for rendering."""
+        queued = queue_position(self.id)
+        with self._lock:
+            return {
+                "id": self.id,
+                "title": self.title,
+                "word_range": self.word_range,
+                "status": self.status,
+                "completed": list(self.completed),
+                "errors": dict(self.errors),
+                "retries": list(self.retries),
+                "article_text": self.article_text,
+                "tokens_saved": self.tokens_saved,
+                "queued": queued if self.status == RUNNING else None,
+                "results": self.results,
+                "error": self.error,
+                "failed": [] if self.status == RUNNING else [s for s in STAGES if not stage_succeeded(self.partial, s)],
+                "elapsed": (self.finished_at or time.time()) - self.created_at,
+            }
+
+
+class JobManager:
+    """Owns every generation job in the process."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, title, word_range, stream=False, job_id=None, results=None, **options):
+        """Start a job on the shared event loop and return it.
+
+        ``options`` are passed through to arun_stages. With ``stream=True``
+        the article text is collected on the job as it is generated.
+        ``job_id`` and ``results`` resume an earlier job: stages that
+        succeeded in ``results`` are not run again.
+        """
+        job = Job(title, word_range, options, stream=stream, job_id=job_id, results=results)
+        job._save_checkpoint(0, job._checkpoint())
+        coro = arun_stages(
+            title,
+            word_range,
+            on_event=job._on_event,
+            on_delta=job._on_delta if stream else None,
+            on_retry=job._on_retry,
+            results=job.partial,
+            queue_owner=job.id,
+            **options
+        )
+        job.future = asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+        job.future.add_done_callback(job._finish)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        return job
+
+    def resume(self, job_id):
+        """Re-run the stages job ``job_id`` did not finish, reusing its checkpoint.
+
+        The new attempt keeps the job's ID and settings. Works after the job
+        has expired or the server restarted, as long as the checkpoint has
+        not. Returns the job, or None if there is nothing to resume from.
+        """
+        job = self.get(job_id)
+        if job is not None:
+            if job.status == RUNNING:
+                return job
+            # Fresher than the checkpoint, whose last write may still be queued
+            state = {
+                "title": job.title,
+                "word_range": job.word_range,
+                "stream": job.stream,
+                "options": job.options,
+                "results": dict(job.partial),
+            }
+        else:
+            state = load_checkpoint(job_id)
+            if state is None:
+                return None
+        return self.submit(
+            state["title"],
+            state["word_range"],
+            stream=state["stream"],
+            job_id=job_id,
+            results=state["results"],
+            **state["options"]
+        )
+
+    def get(self, job_id):
+        """Return the job with ``job_id``, or None if unknown or expired."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished_at is not None and now - job.finished_at > JOB_RETENTION:
+                del self._jobs[job_id]
+
+
+@st.cache_resource
+def get_job_manager():
+    """Return the process-wide job manager, kept across Streamlit reruns."""
+    return JobManager()
@@ -0,0 +1,302 @@
+"""Per-stage latency, token, cost, cache and retry metrics in Prometheus format.
+
+Stage coroutines are wrapped with ``instrumented(stage)``. Calls made inside a
+stage report cache lookups, token usage, images and retries into that
+stage's record through the ``note_*`` functions. When the stage ends, the
+record is turned into metrics and into attributes on the stage's trace span.
+start_server() publishes the metrics, together with the current rate
+limiter, concurrency and circuit breaker state, at
+``http://METRICS_HOST:METRICS_PORT/metrics``.
+"""
+import asyncio
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from aimd import all_adaptive_limits
+from breaker import CLOSED, HALF_OPEN, OPEN, all_breakers
+from ratelimit import all_limiters
+from singleflight import coalesce_counts
+from tracing import current_span, span
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# 0 disables the endpoint
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+
+# USD prices for cost estimates: chat tokens per million, DALL-E per image
+PRICE_INPUT_PER_1M = float(os.getenv("OPENAI_PRICE_INPUT_PER_1M", "10"))
+PRICE_OUTPUT_PER_1M = float(os.getenv("OPENAI_PRICE_OUTPUT_PER_1M", "30"))
+PRICE_PER_IMAGE = float(os.getenv("DALLE_PRICE_PER_IMAGE", "0.04"))
+
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 180, 300)
+
+logger = logging.getLogger(__name__)
+
+
+class Counter:
+    """A monotonically increasing value per combination of label values."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, value=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def samples(self):
+        """(name, label names, label values, value) rows for exposition."""
+        with self._lock:
+            return [(self.name, self.labels, labels, value) for labels, value in self._values.items()]
+
+
+class Histogram(Counter):
+    """Cumulative bucket counts, sum and count per combination of label values."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts, total, count = self._values.get(labels, ([0] * len(self.buckets), 0.0, 0))
+            counts = [c + (value <= bound) for c, bound in zip(counts, self.buckets)]
+            self._values[labels] = (counts, total + value, count + 1)
+
+    def samples(self):
+        rows = []
+        with self._lock:
+            items = list(self._values.items())
+        names = self.labels + ("le",)
+        for labels, (counts, total, count) in items:
+            for bound, bucket in zip(self.buckets, counts):
+                rows.append((f"{self.name}_bucket", names, labels + (f"{bound:g}",), bucket))
+            rows.append((f"{self.name}_bucket", names, labels + ("+Inf",), count))
+            rows.append((f"{self.name}_sum", self.labels, labels, total))
+            rows.append((f"{self.name}_count", self.labels, labels, count))
+        return rows
+
+
+stage_duration = Histogram(
+    "article_stage_duration_seconds", "Wall time of each stage", ("stage", "cache", "outcome")
+)
+stage_calls = Counter("article_stage_calls_total", "Stage runs", ("stage", "cache", "outcome"))
+stage_tokens = Counter("article_stage_tokens_total", "OpenAI tokens used by each stage", ("stage", "type"))
+stage_cost = Counter("article_stage_cost_usd_total", "Estimated OpenAI spend of each stage", ("stage",))
+stage_retries = Counter("article_stage_retries_total", "Upstream retries made by each stage", ("stage",))
+jobs_cancelled = Counter("article_jobs_cancelled_total", "Generations stopped by users")
+cancel_tokens_saved = Counter(
+    "article_cancel_tokens_saved_total", "Estimated completion tokens not spent because of cancellations"
+)
+
+METRICS = (stage_duration, stage_calls, stage_tokens, stage_cost, stage_retries, jobs_cancelled, cancel_tokens_saved)
+
+
+class StageRecord:
+    """What one run of a stage did, filled in by the calls it makes."""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.hits = 0
+        self.misses = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.retries = 0
+
+    @property
+    def cache(self):
+        """Cache outcome: hit if every lookup hit, miss if any missed, none if nothing was looked up."""
+        if self.misses:
+            return "miss"
+        return "hit" if self.hits else "none"
+
+
+_record = contextvars.ContextVar("stage_record", default=None)
+
+
+def instrumented(stage):
+    """Decorate a stage coroutine function to time it and publish its record.
+
+    A stage nested in a run of the same stage (e.g. the section writer
+    falling back to the single-pass writer) is folded into the outer run.
+    The run gets a trace span named ``stage``, unless the current span
+    already has that name, in which case the record is added to it.
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            outer = _record.get()
+            if outer is not None and outer.stage == stage:
+                return await fn(*args, **kwargs)
+            record = StageRecord(stage)
+            token = _record.set(record)
+            parent = current_span()
+            started = time.perf_counter()
+            outcome = "error"
+            with contextlib.nullcontext(parent) if parent and parent.name == stage else span(stage) as stage_span:
+                try:
+                    result = await fn(*args, **kwargs)
+                    outcome = "ok"
+                    return result
+                except asyncio.CancelledError:
+                    outcome = "cancelled"
+                    raise
+                finally:
+                    _record.reset(token)
+                    publish(record, time.perf_counter() - started, outcome)
+                    if stage_span is not None:
+                        stage_span.set(
+                            cache=record.cache,
+                            prompt_tokens=record.prompt_tokens,
+                            completion_tokens=record.completion_tokens,
+                            cost_usd=round(record.cost, 6),
+                            retries=record.retries
+                        )
+        return wrapper
+    return decorate
+
+
+def publish(record, duration, outcome):
+    stage_duration.observe(duration, record.stage, record.cache, outcome)
+    stage_calls.inc(record.stage, record.cache, outcome)
+    if record.prompt_tokens:
+        stage_tokens.inc(record.stage, "prompt", value=record.prompt_tokens)
+    if record.completion_tokens:
+        stage_tokens.inc(record.stage, "completion", value=record.completion_tokens)
+    if record.cost:
+        stage_cost.inc(record.stage, value=record.cost)
+    if record.retries:
+        stage_retries.inc(record.stage, value=record.retries)
+
+
+def note_cache(hit):
+    record = _record.get()
+    if record is not None:
+        if hit:
+            record.hits += 1
+        else:
+            record.misses += 1
+
+
+def note_usage(usage):
+    """Add a chat response's ``usage`` (which may be None) to the current stage."""
+    record = _record.get()
+    if record is None or usage is None:
+        return
+    prompt = getattr(usage, "prompt_tokens", 0) or 0
+    completion = getattr(usage, "completion_tokens", 0) or 0
+    record.prompt_tokens += prompt
+    record.completion_tokens += completion
+    record.cost += (prompt * PRICE_INPUT_PER_1M + completion * PRICE_OUTPUT_PER_1M) / 1_000_000
+
+
+def note_image():
+    record = _record.get()
+    if record is not None:
+        record.cost += PRICE_PER_IMAGE
+
+
+def note_retry():
+    record = _record.get()
+    if record is not None:
+        record.retries += 1
+
+
+def _gauges():
+    """Current state of the shared limiters and breakers, as (name, help, label names, rows)."""
+    limits = [s.snapshot() for s in all_adaptive_limits()]
+    buckets = [s.snapshot() for s in all_limiters()]
+    breakers = [b.snapshot() for b in all_breakers()]
+    states = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+    return [
+        ("upstream_concurrency_limit", "Adaptive concurrency limit per provider", ("provider",),
+         [((s["name"],), s["limit"]) for s in limits]),
+        ("upstream_in_flight", "Calls in flight per provider", ("provider",),
+         [((s["name"],), s["in_flight"]) for s in limits]),
+        ("upstream_concurrency_waiting", "Calls waiting for a concurrency slot", ("provider",),
+         [((s["name"],), s["queued"]) for s in limits]),
+        ("upstream_concurrency_decreases_total", "Multiplicative limit decreases", ("provider",),
+         [((s["name"],), s["decreases"]) for s in limits]),
+        ("rate_limit_queued", "Calls queued for the rate limit", ("model",),
+         [((s["name"],), s["queued"]) for s in buckets]),
+        ("rate_limit_tokens_available", "Tokens left in the per-minute bucket", ("model",),
+         [((s["name"],), s["tokens"]) for s in buckets]),
+        ("rate_limit_requests_available", "Requests left in the per-minute bucket", ("model",),
+         [((s["name"],), s["requests"]) for s in buckets]),
+        ("circuit_breaker_state", "0 closed, 1 half-open, 2 open", ("provider",),
+         [((s["name"],), states[s["state"]]) for s in breakers]),
+        ("single_flight_coalesced_total", "Calls that shared another caller's upstream call", ("scope",),
+         [((scope,), count) for scope, count in coalesce_counts.items()]),
+    ]
+
+
+def _line(name, label_names, label_values, value):
+    if label_names:
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in label_values)
+        name += "{" + ",".join(f'{n}="{v}"' for n, v in zip(label_names, escaped)) + "}"
+    return f"{name} {value if isinstance(value, int) else repr(float(value))}"
+
+
+def render():
+    """Every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in METRICS:
+        lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.kind}"]
+        lines += [_line(*row) for row in metric.samples()]
+    for name, help, label_names, rows in _gauges():
+        kind = "counter" if name.endswith("_total") else "gauge"
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+        lines += [_line(name, label_names, labels, value) for labels, value in rows]
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Serve /metrics on a daemon thread, once per process; return the server or None.
+
+    Returns None when disabled (port 0) or when the port is already taken,
+    e.g. by another app process on the same host.
+    """
+    global _server
+    with _server_lock:
+        if _server is None and port:
+            try:
+                _server = ThreadingHTTPServer((host, port), _Handler)
+            except OSError as e:
+                logger.warning("Metrics endpoint not started on %s:%d: %s", host, port, e)
+                return None
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    return _server
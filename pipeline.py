@@ -0,0 +1,1013 @@
+"""Article generation stages and the shared event loop they run on.
+
+app.py is re-executed on every Streamlit rerun, so anything that has to live
+for the whole process (the event loop, the async OpenAI client) lives here.
+Each stage has an ``a``-prefixed coroutine that raises on failure and a
+synchronous wrapper with the original name that reports errors through
+Streamlit and returns None.
+"""
+import asyncio
+import base64
+import contextvars
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+import requests
+import streamlit as st
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+# Load environment variables before the modules below read their settings
+load_dotenv()
+
+from aimd import get_adaptive_limit
+from breaker import CircuitOpenError, get_breaker
+from cache import cache_key, get_cache
+from images import DISPLAY_WIDTH, IMAGE_FORMAT, downscale, get_image_store
+from metrics import instrumented, note_cache, note_image, note_retry, note_usage
+from ratelimit import get_limiter
+from retry import RETRYABLE_STATUS, aretry
+from singleflight import single_flight, single_flight_stream
+from tracing import current_span, span, start_trace
+
+# Configure OpenAI
+openai.api_key = os.getenv("OPENAI_API_KEY")
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("outline", "article", "image", "resources")
+
+ARTICLE_MODES = ("single", "sections")
+
+FREEPIK_API_URL = os.getenv("FREEPIK_API_URL", "https://api.freepik.com/v1/resources")
+# Set (with FREEPIK_API_URL) to run against benchmarks/mock_providers.py
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+
+# Number of per-host connection pools, and keep-alive connections kept per host
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "4"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "16"))
+
+# Per-request timeouts in seconds for each stage's OpenAI calls
+STAGE_TIMEOUTS = {
+    "outline": float(os.getenv("OPENAI_TIMEOUT_OUTLINE", "60")),
+    "article": float(os.getenv("OPENAI_TIMEOUT_ARTICLE", "180")),
+    "resources": float(os.getenv("OPENAI_TIMEOUT_RESOURCES", "60")),
+    "image": float(os.getenv("OPENAI_TIMEOUT_IMAGE", "90")),
+}
+
+FREEPIK_TIMEOUT = float(os.getenv("FREEPIK_TIMEOUT", "10"))
+
+# How long Freepik lookups are cached, and the shorter TTL for "no results"
+FREEPIK_CACHE_TTL = float(os.getenv("FREEPIK_CACHE_TTL_HOURS", "72")) * 3600
+FREEPIK_NEGATIVE_TTL = float(os.getenv("FREEPIK_NEGATIVE_TTL_MINUTES", "60")) * 60
+
+IMAGE_DOWNLOAD_TIMEOUT = float(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", "30"))
+
+# "b64_json" returns DALL-E images inline, skipping the download and the
+# expiring URL; "url" returns a link as before
+DALLE_RESPONSE_FORMAT = os.getenv("DALLE_RESPONSE_FORMAT", "b64_json")
+
+# Threads used to decode, resize and store images off the event loop
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+# Candidate images fetched per Freepik lookup, for instant re-rolls
+FREEPIK_CANDIDATES = int(os.getenv("FREEPIK_CANDIDATES", "10"))
+
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+FREEPIK_MAX_RETRIES = int(os.getenv("FREEPIK_MAX_RETRIES", "1"))
+
+# A call and all of its retries must finish within this multiple of its timeout
+RETRY_DEADLINE_FACTOR = float(os.getenv("RETRY_DEADLINE_FACTOR", "2"))
+
+# Hedged image sourcing: seconds to wait for Freepik before also starting
+# DALL-E ("auto" = observed p90 Freepik latency), and the most speculative
+# DALL-E generations allowed per hour as a cost cap
+IMAGE_HEDGE_DELAY = os.getenv("IMAGE_HEDGE_DELAY", "auto")
+IMAGE_HEDGE_MAX_PER_HOUR = int(os.getenv("IMAGE_HEDGE_MAX_PER_HOUR", "20"))
+
+# Rough tokens per English word, for estimates made before a response exists,
+TOKENS_PER_WORD = 1.35
+# and characters per token in a prompt
+CHARS_PER_TOKEN = 4
+
+# Part of every cache key; bump whenever a prompt template changes.
+PROMPT_VERSION = 1
+
+# Max section bodies generated at once in "sections" mode
+SECTION_CONCURRENCY = int(os.getenv("SECTION_CONCURRENCY", "4"))
+
+# Upstream provider behind each retry label, for adaptive concurrency limits
+PROVIDERS = {
+    "outline": "openai",
+    "article": "openai",
+    "resources": "openai",
+    "image": "openai",
+    "freepik": "freepik",
+}
+
+STAGE_ERRORS = {
+    "outline": "Outline generation",
+    "article": "Article writing",
+    "image": "DALL-E generation",
+    "resources": "Resource suggestion",
+}
+
+_loop = None
+_lock = threading.Lock()
+
+# Set per run by arun_stages; child tasks inherit them.
+_use_cache = contextvars.ContextVar("use_cache", default=True)
+_on_retry = contextvars.ContextVar("on_retry", default=None)
+_queue_owner = contextvars.ContextVar("queue_owner", default=None)
+
+_image_pool = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+# Recent Freepik lookup latencies (seconds) and hedged DALL-E start times
+_freepik_latencies = deque(maxlen=200)
+_hedge_starts = deque()
+
+# Hedged image races in this process: launched, and which provider won
+hedge_counts = Counter()
+
+
+def get_event_loop():
+    """Return the process-wide event loop, starting it on a daemon thread on first use."""
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="pipeline-loop", daemon=True).start()
+    return _loop
+
+
+def run_sync(coro):
+    """Run a coroutine on the shared loop and block until it finishes.
+
+    If the calling thread is interrupted while waiting, the coroutine is
+    cancelled too rather than left running unattended.
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+    try:
+        return future.result()
+    except BaseException:
+        future.cancel()
+        raise
+
+
+def get_async_client():
+    """Return the process-wide async OpenAI client."""
+    return _async_client(id(get_event_loop()))
+
+
+@st.cache_resource
+def _async_client(loop_id):
+    # Keyed on the loop because the client's pooled connections belong to the
+    # loop that opened them; the client and its pool are shared by every session.
+    # Retries are handled by with_retries, so the client itself never retries.
+    return openai.AsyncOpenAI(
+        api_key=openai.api_key,
+        base_url=OPENAI_BASE_URL,
+        max_retries=0,
+        timeout=max(STAGE_TIMEOUTS.values())
+    )
+
+
+@st.cache_resource
+def get_http_session():
+    """Return the process-wide pooled HTTP session, kept across Streamlit reruns.
+
+    Connections are kept alive, so repeat lookups skip the TCP and TLS
+    handshake. At most HTTP_POOL_MAXSIZE connections are opened per host;
+    extra concurrent requests wait for a free one.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        pool_block=True
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def latency_key(kind, completion_tokens):
+    """Adaptive-limit latency window for calls of one kind and similar output size.
+
+    Sizes are bucketed by powers of two, e.g. "article stream <=2048 tokens",
+    so a long completion is never judged slow against short ones.
+    """
+    bucket = 2 ** max(0, math.ceil(math.log2(max(completion_tokens, 1))))
+    return f"{kind} <={bucket} tokens"
+
+
+async def with_retries(label, fn, retries, timeout, latency_window=None, limited=True):
+    """Await ``fn()`` under the shared retry policy.
+
+    The call and its retries get ``RETRY_DEADLINE_FACTOR * timeout`` seconds
+    in total. Retries are logged and reported to the current run's
+    ``on_retry(label, attempt, delay, error)`` callback. Calls to a provider
+    in PROVIDERS first wait for a slot under its adaptive concurrency limit,
+    and every failed attempt is fed back into that limit. The call's latency
+    is compared against others in ``latency_window`` (default: ``label``).
+    Pass ``limited=False`` when the caller already holds the slot, as a
+    streamed completion does until the stream is consumed.
+    """
+    limit = get_adaptive_limit(PROVIDERS[label]) if label in PROVIDERS else None
+    attempts = 0
+
+    async def attempt():
+        nonlocal attempts
+        attempts += 1
+        with span(f"{label} call", attempt=attempts):
+            return await fn()
+
+    def on_retry(attempt, delay, error):
+        logger.warning("%s failed (%s), retry %d in %.1fs", label, error, attempt, delay)
+        note_retry()
+        if current_span():
+            current_span().add_event("retry", attempt=attempt, delay=round(delay, 2), error=str(error))
+        if limit:
+            limit.record_error(label, error)
+        callback = _on_retry.get()
+        if callback:
+            callback(label, attempt, delay, error)
+
+    def call():
+        return aretry(attempt, retries, RETRY_DEADLINE_FACTOR * timeout, label=label, on_retry=on_retry)
+
+    if limit is None or not limited:
+        return await call()
+    return await limit.acall(latency_window or label, call)
+
+
+def completion_key(messages, temperature):
+    """Cache key for a chat completion request."""
+    return cache_key("chat", os.getenv("OPENAI_VERSION"), PROMPT_VERSION, messages, temperature)
+
+
+async def _cache_get(key):
+    """Read ``key`` from the cache off the event loop, under a trace span."""
+    with span("cache lookup") as lookup:
+        value = await asyncio.to_thread(get_cache().get, key)
+        if lookup:
+            lookup.set(hit=value is not None)
+        return value
+
+
+def _cache_reader(key):
+    """How single-flight waiters in other processes pick up the result stored under ``key``.
+
+    None when the cache is bypassed, so only callers in this process share calls.
+    """
+    if not _use_cache.get():
+        return None
+    return lambda: asyncio.to_thread(get_cache().get, key)
+
+
+def estimate_prompt_tokens(messages):
+    """Rough token count of chat messages, for rate limiting before the call."""
+    return sum(len(m["content"]) for m in messages) // CHARS_PER_TOKEN + 4 * len(messages)
+
+
+async def reserve_chat(stage, messages, completion_tokens=None):
+    """Wait for rate-limit budget for a chat call; return (limiter, tokens reserved).
+
+    Retries of the call go out under the same reservation.
+    """
+    if completion_tokens is None:
+        completion_tokens = estimate_completion_tokens(stage, "")
+    limiter = get_limiter(os.getenv("OPENAI_VERSION"))
+    tokens = estimate_prompt_tokens(messages) + completion_tokens
+    with span("rate limit wait", model=limiter.name, tokens=tokens):
+        return limiter, await limiter.acquire(tokens, owner=_queue_owner.get())
+
+
+async def acomplete(stage, messages, temperature, completion_tokens=None, kind=None):
+    """Run a chat completion for ``stage`` and return its text, serving repeats from the cache.
+
+    When caching is bypassed for the current run the cache is not read, but
+    the fresh response still replaces the stored one. Uncached calls first
+    queue for the model's shared rate limit, reserving the prompt plus
+    ``completion_tokens`` (default: the stage's usual output size).
+    Identical concurrent requests share a single call. ``kind`` (default:
+    ``stage``) separates calls of one stage that differ in length, such as
+    section bodies, for the adaptive limit's latency signal.
+    """
+    if completion_tokens is None:
+        completion_tokens = estimate_completion_tokens(stage, "")
+    key = completion_key(messages, temperature)
+    if _use_cache.get():
+        cached = await _cache_get(key)
+        note_cache(cached is not None)
+        if cached is not None:
+            return cached
+    else:
+        note_cache(False)
+
+    async def call():
+        limiter, reserved = await reserve_chat(stage, messages, completion_tokens)
+        response = await with_retries(
+            stage,
+            lambda: get_async_client().chat.completions.create(
+                model=os.getenv("OPENAI_VERSION"),
+                messages=messages,
+                temperature=temperature,
+                timeout=STAGE_TIMEOUTS[stage]
+            ),
+            OPENAI_MAX_RETRIES,
+            STAGE_TIMEOUTS[stage],
+            latency_window=latency_key(kind or stage, completion_tokens)
+        )
+        usage = getattr(response, "usage", None)
+        limiter.settle(reserved, getattr(usage, "total_tokens", None))
+        note_usage(usage)
+        choice = response.choices[0]
+        content = choice.message.content
+        if not content:
+            # A refusal or content-filter stop comes back without text; fail the stage instead of caching it.
+            raise RuntimeError(f"OpenAI returned no text for the {stage} (finish reason: {choice.finish_reason})")
+        await asyncio.to_thread(get_cache().set, key, content)
+        return content
+
+    return await single_flight(key, call, _cache_reader(key))
+
+
+def normalize_title(title):
+    """Case- and whitespace-insensitive form of a title, for cache keys."""
+    return " ".join(title.casefold().split())
+
+
+def _preview_url(item):
+    if "attributes" in item and "preview" in item["attributes"]:
+        return item["attributes"]["preview"].get("url")
+    elif "images" in item and "preview" in item["images"]:
+        return item["images"]["preview"].get("url")
+    return None
+
+
+@instrumented("freepik")
+async def aget_freepik_images(title):
+    """Get up to FREEPIK_CANDIDATES preview URLs for a title from Freepik in one call.
+
+    Answers are cached per normalized title: found images for
+    FREEPIK_CACHE_TTL, "no results" for the shorter FREEPIK_NEGATIVE_TTL, so
+    known misses go straight to the fallback. Concurrent lookups of the same
+    normalized title share one request.
+    """
+    api_key = os.getenv("FREEPIK_API_KEY")
+    if not api_key:
+        return []
+
+    key = cache_key("freepik", FREEPIK_API_URL, FREEPIK_CANDIDATES, normalize_title(title))
+    if _use_cache.get():
+        cached = await _cache_get(key)
+        note_cache(cached is not None)
+        if cached is not None:
+            return json.loads(cached)["urls"]
+    else:
+        note_cache(False)
+
+    headers = {"Authorization": f"Bearer {api_key}"}
+    params = {
+        "term": title,
+        "limit": FREEPIK_CANDIDATES,
+        "filters[content_type]": "photo"
+    }
+
+    async def read_cached():
+        cached = await asyncio.to_thread(get_cache().get, key)
+        return None if cached is None else json.loads(cached)["urls"]
+
+    async def search():
+        response = await asyncio.to_thread(
+            get_http_session().get,
+            FREEPIK_API_URL,
+            headers=headers,
+            params=params,
+            timeout=FREEPIK_TIMEOUT
+        )
+        if response.status_code in RETRYABLE_STATUS:
+            response.raise_for_status()
+        return response
+
+    async def lookup():
+        # While Freepik keeps failing the breaker is open and this raises
+        # CircuitOpenError straight away instead of waiting out the timeout.
+        started = time.monotonic()
+        response = await get_breaker("freepik").acall(
+            lambda: with_retries("freepik", search, FREEPIK_MAX_RETRIES, FREEPIK_TIMEOUT)
+        )
+        _freepik_latencies.append(time.monotonic() - started)
+
+        if response.status_code != 200:
+            return []
+        urls = [url for url in map(_preview_url, response.json().get("data") or []) if url]
+        ttl = FREEPIK_CACHE_TTL if urls else FREEPIK_NEGATIVE_TTL
+        await asyncio.to_thread(get_cache().set, key, json.dumps({"urls": urls}), ttl)
+        return urls
+
+    return await single_flight(key, lookup, read_cached if _use_cache.get() else None)
+
+
+async def aget_freepik_image(title):
+    """Attempt to get an image from Freepik API."""
+    urls = await aget_freepik_images(title)
+    return urls[0] if urls else None
+
+
+@instrumented("dalle")
+async def _dalle_request(title, response_format):
+    await get_limiter("dall-e-3").acquire(0, owner=_queue_owner.get())
+    response = await with_retries(
+        "image",
+        lambda: get_async_client().images.generate(
+            model="dall-e-3",
+            prompt=f"Create a modern, professional header image for an article titled '{title}'. The image should be visually appealing and relevant to the topic.",
+            size="1024x1024",
+            quality="standard",
+            n=1,
+            response_format=response_format,
+            timeout=STAGE_TIMEOUTS["image"]
+        ),
+        OPENAI_MAX_RETRIES,
+        STAGE_TIMEOUTS["image"]
+    )
+    note_image()
+    return response
+
+
+async def agenerate_dalle_image(title):
+    """Generate an image using DALL-E as fallback."""
+    response = await _dalle_request(title, "url")
+    return response.data[0].url
+
+
+async def agenerate_dalle_blob(title):
+    """Generate a DALL-E image as base64 and put it straight into the image store.
+
+    Returns the blob digest. The payload is decoded, downscaled and written
+    on the image thread pool so a large response never blocks the loop.
+    """
+    response = await _dalle_request(title, "b64_json")
+    return await _in_image_pool(_store_b64, response.data[0].b64_json)
+
+
+def _store_b64(payload):
+    return get_image_store().put(downscale(base64.b64decode(payload)))
+
+
+async def _in_image_pool(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_image_pool, fn, *args)
+
+
+@instrumented("outline")
+async def agenerate_outline(title, word_range):
+    """Generate article outline using GPT-4 Turbo."""
+    return await acomplete(
+        "outline",
+        messages=[{
+            "role": "user",
+            "content": f"Create a detailed, structured outline for an article titled '{title}' that should be approximately {word_range} words. Format it as a clear, hierarchical outline with main sections and subsections."
+        }],
+        temperature=0.7,
+        completion_tokens=estimate_completion_tokens("outline", word_range)
+    )
+
+
+def article_messages(title, outline, word_range):
+    """Build the chat messages for the full-article prompt."""
+    return [{
+        "role": "user",
+        "content": f"Write a complete, well-researched article titled '{title}' using this outline:\n\n{outline}\n\nThe article should be approximately {word_range} words. Make it engaging, informative, and professional. Include an introduction, well-structured body paragraphs, and a conclusion."
+    }]
+
+
+@instrumented("article")
+async def awrite_article(title, outline, word_range):
+    """Write full article using the outline and word range."""
+    return await acomplete(
+        "article",
+        messages=article_messages(title, outline, word_range),
+        temperature=0.8,
+        completion_tokens=estimate_completion_tokens("article", word_range)
+    )
+
+
+async def astream_article(title, outline, word_range):
+    """Yield the article text chunk by chunk as the model produces it.
+
+    Concurrent streams of the same article share one upstream stream.
+    """
+    messages = article_messages(title, outline, word_range)
+    key = completion_key(messages, 0.8)
+    if _use_cache.get():
+        cached = await _cache_get(key)
+        note_cache(cached is not None)
+        if cached is not None:
+            yield cached
+            return
+    else:
+        note_cache(False)
+
+    async def generate():
+        completion_tokens = estimate_completion_tokens("article", word_range)
+        limiter, reserved = await reserve_chat("article", messages, completion_tokens)
+        usage = None
+        # The concurrency slot is held until the stream ends, not just while it opens.
+        async with get_adaptive_limit(PROVIDERS["article"]).slot(latency_key("article stream", completion_tokens)):
+            # Only opening the stream is retried; a stream that breaks part-way fails.
+            stream = await with_retries(
+                "article",
+                lambda: get_async_client().chat.completions.create(
+                    model=os.getenv("OPENAI_VERSION"),
+                    messages=messages,
+                    temperature=0.8,
+                    stream=True,
+                    # Token usage arrives in one last chunk with no choices.
+                    stream_options={"include_usage": True},
+                    timeout=STAGE_TIMEOUTS["article"]
+                ),
+                OPENAI_MAX_RETRIES,
+                STAGE_TIMEOUTS["article"],
+                limited=False
+            )
+            chunks = []
+            try:
+                async for chunk in stream:
+                    if getattr(chunk, "usage", None):
+                        usage = chunk.usage
+                        note_usage(usage)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        chunks.append(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+            finally:
+                # On cancellation (of every reader) this closes the HTTP
+                # connection, which stops generation (and billing) upstream.
+                await stream.close()
+                # A stream cut short has no usage; the reservation then stands.
+                limiter.settle(reserved, getattr(usage, "total_tokens", None))
+        await asyncio.to_thread(get_cache().set, key, "".join(chunks))
+
+    async for chunk in single_flight_stream(key, generate, _cache_reader(key)):
+        yield chunk
+
+
+_HEADING = re.compile(r"^(#{1,6})\s+(.+)$")
+# Numbered items, optionally in bold as GPT often writes them: "**I. Introduction**"
+_TOP_LEVEL_ITEM = re.compile(r"^(?:\*\*|__)?([IVXLC]+|\d+)[.)]\s+(.+)$")
+_BOOKEND = re.compile(r"\b(intro(duction)?|conclusion)\b", re.IGNORECASE)
+
+
+def _roman(number):
+    numeral = ""
+    for value, letters in ((100, "C"), (90, "XC"), (50, "L"), (40, "XL"), (10, "X"), (9, "IX"), (5, "V"), (4, "IV"), (1, "I")):
+        count, number = divmod(number, value)
+        numeral += letters * count
+    return numeral
+
+
+def _clean_heading(text):
+    text = text.strip().strip("*_").strip()
+    text = re.sub(r"^(?:[IVXLC]+|\d+)[.)]\s+", "", text)
+    return text.strip("*_").rstrip(":").strip()
+
+
+def parse_outline(outline):
+    """Split an outline into (heading, notes) pairs for its top-level sections.
+
+    Understands markdown headings (using the shallowest level that repeats)
+    and unindented, optionally bold, ``I.`` / ``1.`` numbering, which is used
+    when no heading level repeats, e.g. under a lone ``#`` title. Only the
+    next number in the outline's sequence (I, II, III... or 1, 2, 3...)
+    starts a section, so unindented sub-items such as ``C. Maturity`` stay
+    in the notes.
+    """
+    lines = outline.splitlines()
+    levels = [len(m.group(1)) for m in map(_HEADING.match, lines) if m]
+    repeated = [level for level in set(levels) if levels.count(level) > 1]
+    if repeated:
+        top = min(repeated)
+
+        def heading(line):
+            m = _HEADING.match(line)
+            return m.group(2) if m and len(m.group(1)) == top else None
+    else:
+        count, roman = 0, False
+
+        def heading(line):
+            nonlocal count, roman
+            m = _TOP_LEVEL_ITEM.match(line)
+            if not m:
+                return None
+            if count == 0:
+                roman = m.group(1) == "I"
+            if m.group(1) != (_roman(count + 1) if roman else str(count + 1)):
+                return None
+            count += 1
+            return m.group(2)
+
+    sections = []
+    for line in lines:
+        text = heading(line)
+        if text is not None:
+            sections.append((_clean_heading(text), []))
+        elif sections and line.strip():
+            sections[-1][1].append(line)
+    return [(title, "\n".join(notes)) for title, notes in sections]
+
+
+def estimate_completion_tokens(stage, word_range):
+    """Rough size of a stage's LLM output in tokens, before any response exists."""
+    words = {
+        "outline": 300,
+        "article": parse_word_target(word_range) or 1000,
+        "resources": 350,
+    }.get(stage, 0)
+    return int(words * TOKENS_PER_WORD)
+
+
+def parse_word_target(word_range):
+    """Turn a word range such as "800-1000" into a single target, or None."""
+    numbers = [int(n.replace(",", "")) for n in re.findall(r"\d[\d,]*", word_range)][:2]
+    if not numbers:
+        return None
+    return sum(numbers) // len(numbers)
+
+
+async def awrite_section(title, outline, heading, notes, words):
+    """Write the body of one outline section."""
+    return await acomplete(
+        "article",
+        messages=[{
+            "role": "user",
+            "content": f"You are writing one section of an article titled '{title}'. The full outline is:\n\n{outline}\n\nWrite only the body of the section '{heading}', covering these points:\n\n{notes}\n\nAim for about {words} words. Do not repeat the section heading and do not write an introduction or conclusion for the article."
+        }],
+        temperature=0.8,
+        completion_tokens=int(words * TOKENS_PER_WORD),
+        kind="section"
+    )
+
+
+async def awrite_bookend(title, part, body, words):
+    """Write the introduction or conclusion for an already written article body."""
+    return await acomplete(
+        "article",
+        messages=[{
+            "role": "user",
+            "content": f"Here is the body of an article titled '{title}':\n\n{body}\n\nWrite an engaging {part} for it of about {words} words. Return only the {part} text, without a heading."
+        }],
+        temperature=0.8,
+        completion_tokens=int(words * TOKENS_PER_WORD),
+        kind="bookend"
+    )
+
+
+@instrumented("article")
+async def awrite_article_sections(title, outline, word_range):
+    """Write the article section by section, generating section bodies in parallel.
+
+    Sections come from parse_outline; at most SECTION_CONCURRENCY bodies are
+    in flight at once. The introduction and conclusion are written afterwards
+    from the assembled body. Falls back to awrite_article when the outline
+    has fewer than two body sections.
+    """
+    sections = [(h, notes) for h, notes in parse_outline(outline) if not _BOOKEND.search(h)]
+    if len(sections) < 2:
+        return await awrite_article(title, outline, word_range)
+
+    target = parse_word_target(word_range) or 1000
+    # Leave roughly a fifth of the budget for the introduction and conclusion.
+    section_words = max(100, int(target * 0.8 / len(sections)))
+    bookend_words = max(50, int(target * 0.1))
+    limit = asyncio.Semaphore(SECTION_CONCURRENCY)
+
+    async def write(heading, notes):
+        async with limit:
+            return await awrite_section(title, outline, heading, notes, section_words)
+
+    bodies = await asyncio.gather(*(write(h, notes) for h, notes in sections))
+    body = "\n\n".join(f"## {h}\n\n{text}" for (h, _), text in zip(sections, bodies))
+    intro, conclusion = await asyncio.gather(
+        awrite_bookend(title, "introduction", body, bookend_words),
+        awrite_bookend(title, "conclusion", body, bookend_words),
+    )
+    return f"{intro}\n\n{body}\n\n## Conclusion\n\n{conclusion}"
+
+
+@instrumented("resources")
+async def asuggest_resources(title):
+    """Suggest authoritative resources related to the article topic."""
+    return await acomplete(
+        "resources",
+        messages=[{
+            "role": "user",
+            "content": f"Provide 5 authoritative online resources (websites, articles, studies, or references) related to '{title}'. Format each as a clear title and description. Include why each resource is valuable."
+        }],
+        temperature=0.7
+    )
+
+
+def hedge_delay():
+    """Seconds to give Freepik before hedging with DALL-E."""
+    if IMAGE_HEDGE_DELAY != "auto":
+        return float(IMAGE_HEDGE_DELAY)
+    if len(_freepik_latencies) < 10:
+        return FREEPIK_TIMEOUT / 2
+    latencies = sorted(_freepik_latencies)
+    return latencies[int(0.9 * (len(latencies) - 1))]
+
+
+def _take_hedge_budget():
+    # Only touched from the event loop thread, so no lock is needed.
+    now = time.monotonic()
+    while _hedge_starts and now - _hedge_starts[0] > 3600:
+        _hedge_starts.popleft()
+    if len(_hedge_starts) >= IMAGE_HEDGE_MAX_PER_HOUR:
+        return False
+    _hedge_starts.append(now)
+    return True
+
+
+async def astore_image(url):
+    """Download an image once, downscale it and keep it in the local image store.
+
+    Returns the blob digest. The URL -> digest mapping is cached, so cycling
+    back to an image that is already stored does not download it again, and
+    concurrent requests for the same URL share one download.
+    """
+    key = cache_key("image", url, DISPLAY_WIDTH, IMAGE_FORMAT)
+
+    async def read_cached():
+        digest = await _cache_get(key)
+        if digest is not None and await asyncio.to_thread(get_image_store().has, digest):
+            return digest
+        return None
+
+    digest = await read_cached()
+    if digest is not None:
+        return digest
+
+    async def download():
+        response = await asyncio.to_thread(get_http_session().get, url, timeout=IMAGE_DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+        return response.content
+
+    async def fetch():
+        data = await with_retries("image_download", download, 1, IMAGE_DOWNLOAD_TIMEOUT)
+        # Decoding and resizing are CPU-bound, so keep them off the event loop.
+        digest = await _in_image_pool(lambda: get_image_store().put(downscale(data)))
+        await asyncio.to_thread(get_cache().set, key, digest)
+        return digest
+
+    return await single_flight(key, fetch, read_cached)
+
+
+async def _store_or_none(url):
+    try:
+        return await astore_image(url)
+    except Exception as e:
+        logger.warning("Could not store header image %s: %s", url, e)
+        return None
+
+
+async def _freepik_candidates(title):
+    try:
+        return await aget_freepik_images(title), None
+    except CircuitOpenError:
+        return [], None
+    except Exception as e:
+        logger.warning("Freepik API error: %s", e)
+        return [], None
+
+
+async def _dalle_candidates(title, dalle_format):
+    async def generate():
+        if dalle_format == "b64_json":
+            return [], await agenerate_dalle_blob(title)
+        url = await agenerate_dalle_image(title)
+        return ([url] if url else []), None
+
+    # DALL-E results are not cached, so only callers in this process can share one.
+    return await single_flight(cache_key("dalle", normalize_title(title), dalle_format), generate)
+
+
+async def agenerate_header_images(title, hedge=False, dalle_format=DALLE_RESPONSE_FORMAT):
+    """Find header image candidates with Freepik first, DALL-E fallback.
+
+    Returns ``(urls, source, blob)``: every Freepik candidate URL, or the
+    DALL-E image, or ``([], None, None)``. A DALL-E image requested as
+    ``b64_json`` has no URL; it is already in the image store and ``blob`` is
+    its digest. With ``hedge=True``, if Freepik has not answered within
+    hedge_delay() DALL-E is started alongside it and whichever returns an
+    image first wins; the other request is cancelled. Hedging is skipped once
+    IMAGE_HEDGE_MAX_PER_HOUR speculative generations have been spent.
+    """
+    freepik = asyncio.ensure_future(_freepik_candidates(title))
+    if hedge and os.getenv("FREEPIK_API_KEY"):
+        await asyncio.wait({freepik}, timeout=hedge_delay())
+        if not freepik.done() and _take_hedge_budget():
+            return await _race_images(title, freepik, dalle_format)
+
+    urls, blob = await freepik
+    if urls:
+        return urls, "Freepik", blob
+
+    urls, blob = await _dalle_candidates(title, dalle_format)
+    if urls or blob:
+        return urls, "DALL-E", blob
+
+    return [], None, None
+
+
+async def agenerate_header_image(title, hedge=False):
+    """Generate header image with Freepik first, DALL-E fallback."""
+    urls, source, _ = await agenerate_header_images(title, hedge, dalle_format="url")
+    return (urls[0], source) if urls else (None, None)
+
+
+async def _race_images(title, freepik, dalle_format):
+    hedge_counts["launched"] += 1
+    dalle = asyncio.ensure_future(_dalle_candidates(title, dalle_format))
+    pending = {freepik: "Freepik", dalle: "DALL-E"}
+    error = None
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                source = pending.pop(task)
+                if task.exception() is not None:
+                    error = task.exception()
+                elif any(task.result()):
+                    hedge_counts["dalle_won" if source == "DALL-E" else "freepik_won"] += 1
+                    urls, blob = task.result()
+                    return urls, source, blob
+    finally:
+        # Cancelling closes the losing request; DALL-E may still bill for it
+        # if generation had already started upstream.
+        for task in pending:
+            task.cancel()
+    if error is not None:
+        raise error
+    return [], None, None
+
+
+def stage_succeeded(results, stage):
+    """Whether ``results`` holds usable output for ``stage``."""
+    value = results.get(stage)
+    if stage == "image":
+        return bool(value) and (value[0] is not None or results.get("image_blob") is not None)
+    return bool(value)
+
+
+async def arun_stages(title, word_range, on_event=None, on_delta=None, article_mode="single", use_cache=True,
+                      on_retry=None, hedge_images=False, results=None, queue_owner=None, trace_id=None):
+    """Run every stage, starting each one as soon as its inputs are ready.
+
+    The image and resources stages only need the title, so they run alongside
+    the outline -> article chain. ``on_event(stage, result, error)`` is called
+    on the loop thread as each stage finishes; a failed stage reports a None
+    result and its exception. ``article_mode`` is one of ARTICLE_MODES. In
+    "single" mode, if ``on_delta`` is given the article is streamed and
+    ``on_delta(chunk)`` is called for every chunk of text. With
+    ``use_cache=False`` cached LLM responses are ignored and refreshed.
+    ``on_retry(label, attempt, delay, error)`` is called on the loop thread
+    before every retry. ``hedge_images`` enables hedged image sourcing.
+    Returns a dict of stage results, plus ``image_candidates`` with every
+    header image URL found and ``image_blob``, the image store digest of the
+    chosen one (None if it could not be stored). A base64 DALL-E image has a
+    blob but no URL. The article stage is absent if the outline failed.
+
+    ``results`` may be the dict returned by an earlier, partly failed run:
+    stages that succeeded there are reported through ``on_event`` again but
+    not re-run. It is filled in place as stages finish, so a caller holding
+    it sees partial results while the run is in progress. Calls waiting for
+    the shared rate limit are tagged with ``queue_owner``, for
+    ratelimit.queue_position(). The run is recorded as one trace, with id
+    ``trace_id`` if given; the id is returned as ``results["trace_id"]``.
+    """
+    _use_cache.set(use_cache)
+    _on_retry.set(on_retry)
+    _queue_owner.set(queue_owner)
+    results = {} if results is None else results
+
+    async def stage(name, run):
+        error = None
+        with span(name) as stage_span:
+            if stage_succeeded(results, name):
+                stage_span.set(reused=True)
+            else:
+                try:
+                    results[name] = await run()
+                except Exception as e:
+                    results[name], error = None, e
+                    stage_span.status = f"error: {e}"
+        if on_event:
+            on_event(name, results[name], error)
+        return results[name]
+
+    @instrumented("article")
+    async def stream_article(outline):
+        chunks = []
+        async for chunk in astream_article(title, outline, word_range):
+            chunks.append(chunk)
+            on_delta(chunk)
+        return "".join(chunks)
+
+    async def header_image():
+        urls, source, blob = await agenerate_header_images(title, hedge=hedge_images)
+        results["image_candidates"] = urls
+        if blob is None and urls:
+            blob = await _store_or_none(urls[0])
+        results["image_blob"] = blob
+        return (urls[0] if urls else None), source
+
+    async def outline_then_article():
+        outline = await stage("outline", lambda: agenerate_outline(title, word_range))
+        if outline:
+            if article_mode == "sections":
+                await stage("article", lambda: awrite_article_sections(title, outline, word_range))
+            elif on_delta:
+                await stage("article", lambda: stream_article(outline))
+            else:
+                await stage("article", lambda: awrite_article(title, outline, word_range))
+
+    with start_trace("generation", trace_id, title=title, word_range=word_range, article_mode=article_mode) as root:
+        results["trace_id"] = root.trace_id
+        await asyncio.gather(
+            outline_then_article(),
+            stage("image", header_image),
+            stage("resources", lambda: asuggest_resources(title)),
+        )
+    return results
+
+
+def get_freepik_image(title):
+    """Attempt to get an image from Freepik API."""
+    try:
+        return run_sync(aget_freepik_image(title))
+    except Exception as e:
+        st.warning(f"Freepik API error: {str(e)}")
+        return None
+
+
+def generate_dalle_image(title):
+    """Generate an image using DALL-E as fallback."""
+    try:
+        return run_sync(agenerate_dalle_image(title))
+    except Exception as e:
+        st.error(f"DALL-E generation error: {str(e)}")
+        return None
+
+
+def generate_outline(title, word_range):
+    """Generate article outline using GPT-4 Turbo."""
+    try:
+        return run_sync(agenerate_outline(title, word_range))
+    except Exception as e:
+        st.error(f"Outline generation error: {str(e)}")
+        return None
+
+
+def write_article(title, outline, word_range):
+    """Write full article using the outline and word range."""
+    try:
+        return run_sync(awrite_article(title, outline, word_range))
+    except Exception as e:
+        st.error(f"Article writing error: {str(e)}")
+        return None
+
+
+def suggest_resources(title):
+    """Suggest authoritative resources related to the article topic."""
+    try:
+        return run_sync(asuggest_resources(title))
+    except Exception as e:
+        st.error(f"Resource suggestion error: {str(e)}")
+        return None
+
+
+def store_image(url):
+    """Download an image into the local image store and return its digest."""
+    try:
+        return run_sync(astore_image(url))
+    except Exception as e:
+        st.warning(f"Image download error: {str(e)}")
+        return None
+
+
+def generate_header_image(title):
+    """Generate header image with Freepik first, DALL-E fallback."""
+    try:
+        return run_sync(agenerate_header_image(title))
+    except Exception as e:
+        st.error(f"DALL-E generation error: {str(e)}")
+        return None, None
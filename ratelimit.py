@@ -0,0 +1,167 @@
+"""Process-wide OpenAI rate limiting with per-model token buckets.
+
+Each model gets one bucket of requests per minute and one of tokens per
+minute, refilled continuously. Callers reserve a request and their estimated
+tokens before calling the API and wait in a single FIFO queue when either
+bucket is short, so concurrent sessions share the account's limits instead
+of all getting 429s at once. A caller never overtakes one queued before it.
+"""
+import asyncio
+import os
+import re
+import threading
+import time
+from collections import deque
+
+
+class _Waiter:
+    __slots__ = ("owner", "tokens", "wake")
+
+    def __init__(self, owner, tokens):
+        self.owner = owner
+        self.tokens = tokens
+        self.wake = asyncio.Event()
+
+
+class RateLimiter:
+    """Requests- and tokens-per-minute buckets for one model, with a fair queue.
+
+    A limit of 0 disables that bucket. Waiters are asyncio objects, so a
+    limiter must only be awaited from the shared pipeline event loop; the
+    lock only keeps snapshot() consistent for other threads.
+    """
+
+    def __init__(self, name, rpm=500, tpm=30000):
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = rpm
+        self.tokens = tpm
+        self.waited = 0
+        self._updated = time.monotonic()
+        self._queue = deque()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm:
+            self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    def _take(self, tokens):
+        """Reserve one request and ``tokens``; return 0, or the seconds until both are available."""
+        with self._lock:
+            self._refill(time.monotonic())
+            waits = []
+            if self.rpm and self.requests < 1:
+                waits.append((1 - self.requests) * 60 / self.rpm)
+            if self.tpm and self.tokens < tokens:
+                waits.append((tokens - self.tokens) * 60 / self.tpm)
+            if waits:
+                return max(waits)
+            if self.rpm:
+                self.requests -= 1
+            if self.tpm:
+                self.tokens -= tokens
+            return 0
+
+    async def acquire(self, tokens, owner=None):
+        """Wait for a request slot and ``tokens`` of budget, in arrival order.
+
+        A reservation larger than the whole per-minute budget is capped at it,
+        so it waits for a full bucket instead of forever. ``owner`` tags the
+        queue entry for position(). Returns the tokens reserved.
+        """
+        tokens = min(tokens, self.tpm) if self.tpm else 0
+        waiter = _Waiter(owner, tokens)
+        with self._lock:
+            self._queue.append(waiter)
+            if self._queue[0] is waiter:
+                waiter.wake.set()
+        try:
+            queued = not waiter.wake.is_set()
+            await waiter.wake.wait()
+            # Only the head of the queue takes from the buckets, so nobody
+            # behind it can grab budget it is waiting for.
+            delay = self._take(tokens)
+            if queued or delay:
+                self.waited += 1
+            while delay:
+                await asyncio.sleep(delay)
+                delay = self._take(tokens)
+            return tokens
+        finally:
+            with self._lock:
+                head = self._queue[0] is waiter
+                self._queue.remove(waiter)
+                if head and self._queue:
+                    self._queue[0].wake.set()
+
+    def settle(self, estimated, actual):
+        """Correct a reservation once the real token count is known."""
+        if not self.tpm or actual is None:
+            return
+        with self._lock:
+            self.tokens = min(self.tpm, self.tokens + estimated - actual)
+
+    def position(self, owner):
+        """1-based queue position of ``owner``'s earliest waiting call, or None."""
+        with self._lock:
+            for index, waiter in enumerate(self._queue, 1):
+                if waiter.owner == owner:
+                    return index
+        return None
+
+    def snapshot(self):
+        """Current state as a plain dict, for display."""
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                "name": self.name,
+                "rpm": self.rpm,
+                "tpm": self.tpm,
+                "requests": self.requests,
+                "tokens": self.tokens,
+                "queued": len(self._queue),
+                "waited": self.waited,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(model):
+    """Return the process-wide limiter for ``model``.
+
+    Limits come from ``<MODEL>_RPM`` and ``<MODEL>_TPM``, with the model name
+    upper-cased and punctuation replaced by underscores (``GPT_4_TURBO_RPM``),
+    falling back to OPENAI_RPM and OPENAI_TPM.
+    """
+    model = model or "default"
+    with _limiters_lock:
+        if model not in _limiters:
+            prefix = re.sub(r"[^A-Z0-9]+", "_", model.upper())
+            _limiters[model] = RateLimiter(
+                model,
+                rpm=float(os.getenv(f"{prefix}_RPM") or os.getenv("OPENAI_RPM", "500")),
+                tpm=float(os.getenv(f"{prefix}_TPM") or os.getenv("OPENAI_TPM", "30000"))
+            )
+        return _limiters[model]
+
+
+def all_limiters():
+    """Every limiter created so far."""
+    with _limiters_lock:
+        return list(_limiters.values())
+
+
+def queue_position(owner):
+    """Where ``owner`` is waiting across all limiters, as (model, position), or None."""
+    for limiter in all_limiters():
+        position = limiter.position(owner)
+        if position is not None:
+            return limiter.name, position
+    return None
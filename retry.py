@@ -0,0 +1,94 @@
+"""Retry with jittered exponential backoff for upstream API calls.
+
+Connection errors, timeouts and 408/409/425/429/5xx responses are retried;
+anything else (bad requests, auth failures, exhausted quota) fails at once.
+A server-supplied Retry-After is honoured as the minimum wait.
+"""
+import asyncio
+import email.utils
+import os
+import random
+import time
+
+import openai
+import requests
+
+RETRYABLE_STATUS = frozenset({408, 409, 425, 429, 500, 502, 503, 504})
+
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "1"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "30"))
+
+
+def status_code(error):
+    """Return the HTTP status attached to an API error, if any."""
+    code = getattr(error, "status_code", None)
+    if code is None:
+        code = getattr(getattr(error, "response", None), "status_code", None)
+    return code
+
+
+def is_retryable(error):
+    """Whether ``error`` is transient and worth another attempt."""
+    if isinstance(error, (openai.APIConnectionError, requests.ConnectionError, requests.Timeout, TimeoutError)):
+        return True
+    # OpenAI reports an exhausted quota as a 429 that will never succeed.
+    if getattr(error, "code", None) == "insufficient_quota":
+        return False
+    return status_code(error) in RETRYABLE_STATUS
+
+
+def retry_after(error):
+    """Seconds the server asked us to wait before retrying, or None."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(error, attempt):
+    """Delay before retry number ``attempt`` (1-based): full-jitter exponential backoff."""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+    server_delay = retry_after(error)
+    if server_delay is not None:
+        delay = max(delay, server_delay)
+    return delay
+
+
+async def aretry(fn, retries, deadline, label="call", on_retry=None):
+    """Await ``fn()``, retrying transient errors with jittered exponential backoff.
+
+    Gives up on the first non-retryable error, after ``retries`` retries, or
+    when the next attempt could not start within ``deadline`` seconds of the
+    first; the last error is re-raised. An attempt still running at the
+    deadline is cancelled. ``on_retry(attempt, delay, error)`` is called
+    before each wait.
+    """
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        try:
+            return await asyncio.wait_for(fn(), deadline - (time.monotonic() - start))
+        except Exception as e:
+            elapsed = time.monotonic() - start
+            if isinstance(e, TimeoutError) and elapsed >= deadline:
+                raise TimeoutError(f"{label} did not finish within {deadline:g}s") from e
+            if attempt >= retries or not is_retryable(e):
+                raise
+            attempt += 1
+            delay = backoff_delay(e, attempt)
+            if elapsed + delay >= deadline:
+                raise
+            if on_retry:
+                on_retry(attempt, delay, e)
+            await asyncio.sleep(delay)
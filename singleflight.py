@@ -0,0 +1,184 @@
+"""Single-flight coalescing of identical concurrent upstream calls.
+
+Within a process, concurrent calls with the same key share one task: the
+first caller starts it, later callers await its result, and it is only
+cancelled once every caller has given up. Across processes on the same host
+the task also takes a lease on the key in the SQLite cache. A process that
+finds the lease held waits for the holder's result to appear in the cache
+instead of making the same call; leases are renewed while the call runs and
+expire if the process holding one dies.
+"""
+import asyncio
+import contextlib
+import os
+import socket
+import uuid
+from collections import Counter
+
+from cache import get_cache
+from tracing import span
+
+LEASE_TTL = float(os.getenv("SINGLE_FLIGHT_LEASE_SECONDS", "30"))
+LEASE_POLL = float(os.getenv("SINGLE_FLIGHT_POLL_SECONDS", "0.25"))
+
+# Calls that shared another caller's flight, in this process or another
+coalesce_counts = Counter()
+
+_owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# Only touched from the event loop thread, so no lock is needed.
+_flights = {}
+_streams = {}
+
+
+async def _lease_or_cached(key, read_cached):
+    """Take the cross-process lease on ``key``, or wait for its holder's result.
+
+    Returns ``(True, None)`` once this process holds the lease, or
+    ``(False, value)`` with the value another process left in the cache.
+    """
+    cache = get_cache()
+    waited = False
+    while not await asyncio.to_thread(cache.acquire_lease, key, _owner, LEASE_TTL):
+        if not waited:
+            coalesce_counts["cross_process"] += 1
+            waited = True
+        await asyncio.sleep(LEASE_POLL)
+        value = await read_cached()
+        if value is not None:
+            return False, value
+    if waited:
+        # The previous holder may have finished between our last poll and its release.
+        value = await read_cached()
+        if value is not None:
+            await asyncio.to_thread(cache.release_lease, key, _owner)
+            return False, value
+    return True, None
+
+
+@contextlib.asynccontextmanager
+async def _holding_lease(key):
+    cache = get_cache()
+
+    async def renew():
+        while True:
+            await asyncio.sleep(LEASE_TTL / 3)
+            await asyncio.to_thread(cache.acquire_lease, key, _owner, LEASE_TTL)
+
+    heartbeat = asyncio.ensure_future(renew())
+    try:
+        yield
+    finally:
+        heartbeat.cancel()
+        # Called directly so the lease is released even when cancelled.
+        cache.release_lease(key, _owner)
+
+
+async def _lead(key, fn, read_cached):
+    if read_cached is None:
+        return await fn()
+    held, value = await _lease_or_cached(key, read_cached)
+    if not held:
+        return value
+    async with _holding_lease(key):
+        return await fn()
+
+
+class _Flight:
+    def __init__(self, task):
+        self.task = task
+        self.callers = 0
+
+
+def _forget(flights, key, flight):
+    if flights.get(key) is flight:
+        del flights[key]
+
+
+def _join(flights, key, start):
+    flight = flights.get(key)
+    if flight is None:
+        flight = flights[key] = start()
+        flight.task.add_done_callback(lambda _: _forget(flights, key, flight))
+    else:
+        coalesce_counts["in_process"] += 1
+    flight.callers += 1
+    return flight
+
+
+def _leave(flights, key, flight):
+    flight.callers -= 1
+    if flight.callers == 0 and not flight.task.done():
+        _forget(flights, key, flight)
+        flight.task.cancel()
+
+
+async def single_flight(key, fn, read_cached=None):
+    """Await ``fn()``, sharing one call among all concurrent callers with ``key``.
+
+    ``read_cached()`` should return the value ``fn`` leaves in the shared
+    cache, or None; when it is given, callers in other processes coalesce
+    too. Without it (e.g. when the cache is bypassed) only callers in this
+    process share the call.
+    """
+    joined = key in _flights
+    flight = _join(_flights, key, lambda: _Flight(asyncio.ensure_future(_lead(key, fn, read_cached))))
+    try:
+        with span("coalesced wait", key=key[:12]) if joined else contextlib.nullcontext():
+            return await asyncio.shield(flight.task)
+    finally:
+        _leave(_flights, key, flight)
+
+
+class _StreamFlight(_Flight):
+    def __init__(self):
+        super().__init__(None)
+        self.chunks = []
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    async def run(self, key, make_stream, read_cached):
+        async def consume():
+            async for chunk in make_stream():
+                self.chunks.append(chunk)
+                self.notify()
+
+        try:
+            cached = await _lead(key, consume, read_cached)
+            if cached is not None:
+                self.chunks.append(cached)
+        finally:
+            self.notify()
+
+
+def _start_stream(key, make_stream, read_cached):
+    flight = _StreamFlight()
+    flight.task = asyncio.ensure_future(flight.run(key, make_stream, read_cached))
+    return flight
+
+
+async def single_flight_stream(key, make_stream, read_cached=None):
+    """Like single_flight for an async iterator: every caller gets every chunk.
+
+    Callers that join late first receive the chunks already produced. A
+    result read from another process's cache arrives as a single chunk.
+    """
+    flight = _join(_streams, key, lambda: _start_stream(key, make_stream, read_cached))
+    try:
+        sent = 0
+        while True:
+            changed = flight.changed
+            while sent < len(flight.chunks):
+                yield flight.chunks[sent]
+                sent += 1
+            if flight.task.done():
+                if sent == len(flight.chunks):
+                    flight.task.result()
+                    return
+                continue
+            await changed.wait()
+    finally:
+        _leave(_streams, key, flight)
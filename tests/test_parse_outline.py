@@ -0,0 +1,92 @@
+"""Outline shapes parse_outline has to split for section-parallel writing.
+
+    python -m unittest discover tests
+"""
+import unittest
+
+from pipeline import parse_outline
+
+
+class ParseOutlineTest(unittest.TestCase):
+    def headings(self, outline):
+        return [heading for heading, _ in parse_outline(outline)]
+
+    def test_markdown_headings_skip_lone_title(self):
+        outline = "\n".join([
+            "# The Future of AI",
+            "## Introduction",
+            "- Hook",
+            "## History",
+            "### Early days",
+            "- Perceptrons",
+            "## Conclusion",
+            "- Wrap up",
+        ])
+        self.assertEqual(parse_outline(outline), [
+            ("Introduction", "- Hook"),
+            ("History", "### Early days\n- Perceptrons"),
+            ("Conclusion", "- Wrap up"),
+        ])
+
+    def test_bold_roman_numerals(self):
+        outline = "\n".join([
+            "**I. Introduction**",
+            "- Hook",
+            "**II. Background:**",
+            "- Context",
+            "__III. Methods__",
+            "- Survey",
+            "**IV. Conclusion**",
+        ])
+        self.assertEqual(self.headings(outline), ["Introduction", "Background", "Methods", "Conclusion"])
+
+    def test_title_above_numbered_sections(self):
+        outline = "\n".join([
+            "# The Future of AI",
+            "**I. Introduction**",
+            "- Hook",
+            "**II. History**",
+            "- Origins",
+            "**III. Today**",
+            "- Adoption",
+            "**IV. Conclusion**",
+        ])
+        self.assertEqual(parse_outline(outline), [
+            ("Introduction", "- Hook"),
+            ("History", "- Origins"),
+            ("Today", "- Adoption"),
+            ("Conclusion", ""),
+        ])
+
+    def test_unindented_lettered_sub_items_stay_in_notes(self):
+        outline = "\n".join([
+            "I. Introduction",
+            "A. Hook",
+            "B. Thesis",
+            "II. History",
+            "A. Origins",
+            "B. Winters",
+            "C. Maturity",
+            "III. Conclusion",
+        ])
+        self.assertEqual(parse_outline(outline), [
+            ("Introduction", "A. Hook\nB. Thesis"),
+            ("History", "A. Origins\nB. Winters\nC. Maturity"),
+            ("Conclusion", ""),
+        ])
+
+    def test_arabic_sub_items_under_roman_sections(self):
+        outline = "\n".join([
+            "I. Introduction",
+            "1. Hook",
+            "2. Thesis",
+            "II. Conclusion",
+        ])
+        self.assertEqual(self.headings(outline), ["Introduction", "Conclusion"])
+
+    def test_arabic_numbering(self):
+        self.assertEqual(self.headings("1. Intro\n- a\n2) Body\n- b\n3. End"), ["Intro", "Body", "End"])
+
+
+if __name__ == "__main__":
+    unittest.main()
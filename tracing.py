@@ -0,0 +1,184 @@
+"""Span tracing for article generations, exported to a local JSONL file.
+
+Each generation runs inside one trace (start_trace); stages, cache lookups,
+rate-limit waits and every upstream attempt open child spans with span().
+The current span travels in a contextvar, so spans opened in child tasks
+nest under the stage that started them, and span() outside a trace is a
+no-op. Finished spans are appended to TRACE_PATH by a background thread
+and the most recent traces are also kept in memory for the in-app viewer.
+"""
+import asyncio
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+TRACE_PATH = os.getenv("TRACE_PATH", os.path.join(".cache", "traces.jsonl"))
+TRACE_MAX_BYTES = int(float(os.getenv("TRACE_MAX_MB", "50")) * 1024 * 1024)
+# Traces kept in memory for the viewer
+TRACE_MEMORY = int(os.getenv("TRACE_MEMORY", "200"))
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    """One timed operation within a trace."""
+
+    def __init__(self, trace_id, name, parent_id=None, attributes=None):
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.status = "ok"
+        self.start = time.time()
+        self.end = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add_event(self, name, **attributes):
+        self.events.append({"name": name, "time": time.time(), "attributes": attributes})
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "end": self.end,
+            "status": self.status,
+            "attributes": self.attributes,
+            "events": self.events,
+        }
+
+
+_current = contextvars.ContextVar("span", default=None)
+
+
+def current_span():
+    """The innermost open span, or None outside a trace."""
+    return _current.get()
+
+
+@contextlib.contextmanager
+def _open(span):
+    token = _current.set(span)
+    try:
+        yield span
+    except asyncio.CancelledError:
+        span.status = "cancelled"
+        raise
+    except Exception as e:
+        span.status = f"error: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        span.end = time.time()
+        _export(span)
+
+
+@contextlib.contextmanager
+def start_trace(name, trace_id=None, **attributes):
+    """Open the root span of a new trace (with id ``trace_id`` if given)."""
+    with _open(Span(trace_id or uuid.uuid4().hex, name, attributes=attributes)) as root:
+        yield root
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Open a child of the current span; yields None when not inside a trace."""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    with _open(Span(parent.trace_id, name, parent.span_id, attributes)) as child:
+        yield child
+
+
+_recent = OrderedDict()
+_recent_lock = threading.Lock()
+# Traces read back from the files, so the viewer does not rescan them on every rerun
+_loaded = OrderedDict()
+_queue = queue.Queue()
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _export(span):
+    record = span.to_dict()
+    with _recent_lock:
+        _recent.setdefault(span.trace_id, []).append(record)
+        _recent.move_to_end(span.trace_id)
+        while len(_recent) > TRACE_MEMORY:
+            _recent.popitem(last=False)
+    if TRACE_PATH:
+        _start_writer()
+        _queue.put(record)
+
+
+def _start_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_write_forever, name="trace-writer", daemon=True)
+            _writer.start()
+
+
+def _write_forever():
+    if os.path.dirname(TRACE_PATH):
+        os.makedirs(os.path.dirname(TRACE_PATH), exist_ok=True)
+    while True:
+        records = [_queue.get()]
+        while not _queue.empty():
+            records.append(_queue.get_nowait())
+        try:
+            if os.path.exists(TRACE_PATH) and os.path.getsize(TRACE_PATH) > TRACE_MAX_BYTES:
+                os.replace(TRACE_PATH, f"{TRACE_PATH}.1")
+            with open(TRACE_PATH, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(record) + "\n" for record in records)
+        except OSError as e:
+            logger.warning("Could not write %d spans to %s: %s", len(records), TRACE_PATH, e)
+
+
+def _read_trace(trace_id):
+    spans = []
+    for path in (f"{TRACE_PATH}.1", TRACE_PATH):
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A writer killed mid-append, or still appending, leaves a partial line.
+                    continue
+                if record.get("trace_id") == trace_id:
+                    spans.append(record)
+    return spans
+
+
+def get_trace(trace_id):
+    """Every finished span of ``trace_id``, from memory or the trace files, oldest first.
+
+    A trace read from the files is kept, so it is only read once, even if
+    it was not found.
+    """
+    with _recent_lock:
+        spans = list(_recent.get(trace_id) or _loaded.get(trace_id) or ())
+        read = trace_id in _recent or trace_id in _loaded
+    if not read and TRACE_PATH:
+        spans = _read_trace(trace_id)
+        with _recent_lock:
+            _loaded[trace_id] = spans
+            while len(_loaded) > TRACE_MEMORY:
+                _loaded.popitem(last=False)
+    return sorted(spans, key=lambda s: s["start"])